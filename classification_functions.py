@@ -69,4 +69,14 @@ def classify_user_by_preferences(df, like_dislike_col='like/dislike', weights_co
             continue
 
     best_cluster = int(np.argmax(cluster_scores))
-    return best_cluster, cluster_scores
\ No newline at end of file
+    return best_cluster, cluster_scores
+
+
+# Turns cluster scores into membership probabilities with a softmax. A lower temperature sharpens them toward the
+# argmax cluster, a higher one spreads them over the clusters.
+def membership_probabilities(cluster_scores, temperature=1.0):
+    if temperature <= 0:
+        raise ValueError("temperature must be positive.")
+    scores = np.asarray(cluster_scores, dtype=float) / temperature
+    weights = np.exp(scores - scores.max())
+    return weights / weights.sum()
@@ -0,0 +1,153 @@
+import argparse
+import hashlib
+import os
+import shutil
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, as_completed
+from rankdist_functions import TOP_K, RANK_METHODS, SUBTABLE_COLUMNS
+from rankdist_functions import select_scores, compute_rank_dist, rankdist_answers, answers_subtable
+from rankdist_functions import sample_candidate_sets, simulate_true_orders, open_sample_bank, load_sample_bank
+from rankdist_functions import bank_rank_dist, load_persona_scores
+
+
+# Draws a cluster's candidate sets and simulates their true orders in one batched pass, plus a seed per set
+# for the RankDist computation
+def cluster_sets(catalog, n_sets, set_size, seed, cluster):
+    truth_stream, *set_streams = np.random.SeedSequence([seed, cluster]).spawn(n_sets + 1)
+    rng = np.random.default_rng(truth_stream)
+    candidates = sample_candidate_sets(len(catalog["songs"]), n_sets, set_size, rng)
+    return candidates, simulate_true_orders(catalog, candidates, rng), set_streams
+
+
+# Generates one #SET subtable: RankDist answers for the candidate songs' score model next to their simulated true
+# order (song names). With bank_path, the candidates' samples are sliced from the cluster's sample bank instead of
+# drawn.
+def generate_set(scores, true_songs, k, n_samples, method, seed_seq, adaptive=False, bank_path=None):
+    if bank_path is not None:
+        rank_dist = bank_rank_dist(load_sample_bank(bank_path), scores["songs"], k=k)
+    else:
+        rank_dist = compute_rank_dist(scores, k=k, n_samples=n_samples, seed=seed_seq, method=method,
+                                      adaptive=adaptive and method == "sample")
+    return answers_subtable(scores["songs"], rankdist_answers(rank_dist, k), true_songs, k)
+
+
+# Text of one #SET block in the multi-table format read by other_functions.read_random_subtable
+def set_block(set_number, subtable):
+    marker = f"#SET{set_number}" + "," * (len(SUBTABLE_COLUMNS) - 1)
+    return marker + "\r\n" + subtable.to_csv(index=False, lineterminator="\r\n")
+
+
+# Writes a file atomically so an interrupted run never leaves a half-written checkpoint or cluster file
+def write_atomic(file_path, text):
+    tmp_path = file_path + ".tmp"
+    with open(tmp_path, 'w', encoding='utf-8', newline='') as f:
+        f.write(text)
+    os.replace(tmp_path, file_path)
+
+
+# Checkpoint directory for a run; it depends on the scores and settings, so a changed run starts over
+def checkpoint_dir(out_dir, scores_path, settings):
+    digest = hashlib.sha256(repr(sorted(settings.items())).encode())
+    with open(scores_path, 'rb') as f:
+        digest.update(f.read())
+    return os.path.join(out_dir, ".checkpoints", digest.hexdigest()[:16])
+
+
+# Checkpoint file of one finished set
+def checkpoint_path(run_dir, cluster, set_number):
+    return os.path.join(run_dir, f"cluster_{cluster}", f"set_{set_number}.csv")
+
+
+# Generates alg_results/cluster_N.csv for the given clusters. Sets are spread over a process pool and every
+# finished set is checkpointed, so rerunning the same command after an interruption only generates what is left.
+# With adaptive=True, each set stops sampling once its answers are settled and n_samples is only a cap.
+# With bank_dir, every cluster's catalog is sampled once into a persisted sample bank there (reused by later runs
+# with the same scores and settings) and each set's samples are sliced from it.
+def generate_alg_results(scores_path, out_dir="alg_results", clusters=None, n_sets=50, set_size=5, k=TOP_K,
+                         n_samples=10000, method="sample", n_workers=None, seed=0, adaptive=False, bank_dir=None):
+    catalogs = load_persona_scores(scores_path)
+    clusters = sorted(catalogs) if clusters is None else clusters
+    for cluster in clusters:
+        if cluster not in catalogs:
+            raise ValueError(f"No scores for cluster {cluster} in {scores_path}.")
+        if len(catalogs[cluster]["songs"]) < set_size:
+            raise ValueError(f"Cluster {cluster} has fewer than {set_size} songs.")
+    if bank_dir is not None and (method != "sample" or adaptive):
+        raise ValueError("A sample bank needs the sample method without adaptive stopping.")
+
+    settings = {"n_sets": n_sets, "set_size": set_size, "k": k, "n_samples": n_samples, "method": method,
+                "seed": seed, "adaptive": adaptive,
+                "bank": bank_dir is not None}
+    run_dir = checkpoint_dir(out_dir, scores_path, settings)
+    bank_paths = dict.fromkeys(clusters)
+    if bank_dir is not None:
+        os.makedirs(bank_dir, exist_ok=True)
+        for cluster in clusters:
+            bank_paths[cluster] = os.path.join(bank_dir, f"cluster_{cluster}.npy")
+            open_sample_bank(catalogs[cluster], bank_paths[cluster], n_samples, [seed, cluster])
+    pending = []
+    for cluster in clusters:
+        os.makedirs(os.path.join(run_dir, f"cluster_{cluster}"), exist_ok=True)
+        candidates, true_orders, streams = cluster_sets(catalogs[cluster], n_sets, set_size, seed, cluster)
+        pending += [(cluster, number, candidates[number - 1], true_orders[number - 1], streams[number - 1])
+                    for number in range(1, n_sets + 1)
+                    if not os.path.exists(checkpoint_path(run_dir, cluster, number))]
+
+    total = n_sets * len(clusters)
+    print(f"{total - len(pending)}/{total} sets already checkpointed in {run_dir}")
+    # Workers only get each set's candidate score model, not the whole catalog
+    with ProcessPoolExecutor(max_workers=n_workers) as pool:
+        futures = {}
+        for cluster, number, candidates, true_order, stream in pending:
+            catalog = catalogs[cluster]
+            future = pool.submit(generate_set, select_scores(catalog, candidates),
+                                 [catalog["songs"][i] for i in true_order], k, n_samples, method, stream, adaptive,
+                                 bank_paths[cluster])
+            futures[future] = (cluster, number)
+        for done, future in enumerate(as_completed(futures), start=total - len(pending) + 1):
+            cluster, number = futures[future]
+            write_atomic(checkpoint_path(run_dir, cluster, number), set_block(number, future.result()))
+            print(f"[{done}/{total}] cluster {cluster} set {number}")
+
+    for cluster in clusters:
+        blocks = []
+        for number in range(1, n_sets + 1):
+            with open(checkpoint_path(run_dir, cluster, number), encoding='utf-8', newline='') as f:
+                blocks.append(f.read())
+        write_atomic(os.path.join(out_dir, f"cluster_{cluster}.csv"), "".join(blocks))
+        print(f"Wrote {os.path.join(out_dir, f'cluster_{cluster}.csv')}")
+    # Runs with the same settings share run_dir, so only this run's clusters are cleared; another run's interrupted
+    # clusters keep their checkpoints
+    for cluster in clusters:
+        shutil.rmtree(os.path.join(run_dir, f"cluster_{cluster}"))
+    if not os.listdir(run_dir):
+        os.rmdir(run_dir)
+    if not os.listdir(os.path.dirname(run_dir)):
+        os.rmdir(os.path.dirname(run_dir))
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Regenerate alg_results/cluster_N.csv with the RankDist engine.")
+    parser.add_argument("scores", help="CSV with columns cluster, song, mean, std")
+    parser.add_argument("--out-dir", default="alg_results")
+    parser.add_argument("--clusters", type=int, nargs="+", help="clusters to generate (default: all in the scores)")
+    parser.add_argument("--sets", type=int, default=50, help="sets per cluster")
+    parser.add_argument("--set-size", type=int, default=5, help="candidate songs per set")
+    parser.add_argument("--k", type=int, default=TOP_K)
+    parser.add_argument("--samples", type=int, default=10000)
+    parser.add_argument("--method", choices=RANK_METHODS, default="sample")
+    parser.add_argument("--adaptive", action="store_true",
+                        help="stop sampling a set once its answers are settled (--samples becomes a cap)")
+    parser.add_argument("--bank-dir", help="sample each cluster's catalog once into a sample bank in this directory "
+                                           "and slice every set's samples from it")
+    parser.add_argument("--workers", type=int, default=None, help="worker processes (default: every core)")
+    parser.add_argument("--seed", type=int, default=0)
+    args = parser.parse_args()
+
+    generate_alg_results(args.scores, out_dir=args.out_dir, clusters=args.clusters, n_sets=args.sets,
+                         set_size=args.set_size, k=args.k, n_samples=args.samples, method=args.method,
+                         n_workers=args.workers, seed=args.seed, adaptive=args.adaptive, bank_dir=args.bank_dir)
+
+
+if __name__ == "__main__":
+    main()
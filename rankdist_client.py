@@ -0,0 +1,108 @@
+import argparse
+import csv
+import json
+import random
+import time
+import urllib.error
+import urllib.request
+from concurrent.futures import ThreadPoolExecutor
+
+# Same default as rankdist_functions.TOP_K, kept here so the client does not import the engine
+TOP_K = 3
+SERVICE_URL = "http://127.0.0.1:8765"
+SERVICE_TIMEOUT = 30.0
+
+
+# Sends requests (dicts as in rankdist_functions.batch_answers) to the RankDist service and returns their answers
+# in order. Only does I/O, so a Streamlit script thread can call it while the engine runs in the service.
+# A request the service rejects raises ValueError with the service's message.
+def query_service(requests, url=SERVICE_URL, timeout=SERVICE_TIMEOUT):
+    body = json.dumps({"requests": list(requests)}).encode()
+    http_request = urllib.request.Request(url + "/answers", data=body, method="POST",
+                                          headers={"content-type": "application/json"})
+    try:
+        with urllib.request.urlopen(http_request, timeout=timeout) as response:
+            results = json.loads(response.read())["results"]
+    except urllib.error.HTTPError as error:
+        raise ValueError(json.loads(error.read()).get("error", str(error)))
+    errors = [result["error"] for result in results if "error" in result]
+    if errors:
+        raise ValueError(errors[0])
+    return [result["answer"] for result in results]
+
+
+# One persona's answer for a candidate set, like rankdist_functions.rankdist_answer but from the service
+def service_answer(persona, songs, mode, k=TOP_K, url=SERVICE_URL):
+    return query_service([{"persona": persona, "songs": list(songs), "mode": mode, "k": k}], url)[0]
+
+
+# One blended user's answer for a candidate set (memberships: persona -> membership probability)
+def service_mixture_answer(memberships, songs, mode, k=TOP_K, url=SERVICE_URL):
+    request = {"memberships": {str(persona): w for persona, w in memberships.items()}, "songs": list(songs),
+               "mode": mode, "k": k}
+    return query_service([request], url)[0]
+
+
+# Whether a RankDist service answers at url
+def service_available(url=SERVICE_URL, timeout=1.0):
+    try:
+        with urllib.request.urlopen(url + "/health", timeout=timeout) as response:
+            return json.loads(response.read()).get("status") == "ok"
+    except (OSError, ValueError):
+        return False
+
+
+# Stands in for many concurrent Streamlit sessions: each session thread sends one query at a time for random
+# candidate sets of a persona's songs. Returns the per-query latencies in seconds and the total wall time.
+def simulate_sessions(catalogs, n_sessions, n_queries, set_size=5, k=TOP_K, url=SERVICE_URL, seed=0):
+    modes = ("relevant_set", "ordered_list", "perfect_precision")
+
+    def session(number):
+        rng = random.Random(seed * 100003 + number)
+        latencies = []
+        for _ in range(n_queries):
+            persona = rng.choice(sorted(catalogs))
+            songs = rng.sample(catalogs[persona], set_size)
+            start = time.perf_counter()
+            service_answer(persona, songs, rng.choice(modes), k, url)
+            latencies.append(time.perf_counter() - start)
+        return latencies
+
+    start = time.perf_counter()
+    with ThreadPoolExecutor(max_workers=n_sessions) as pool:
+        latencies = [latency for session_latencies in pool.map(session, range(n_sessions))
+                     for latency in session_latencies]
+    return latencies, time.perf_counter() - start
+
+
+# Distinct song names per persona from a scores CSV (columns cluster, song, mean, std)
+def read_catalog_songs(file_path):
+    catalogs = {}
+    with open(file_path, encoding='utf-8-sig', newline='') as f:
+        for row in csv.DictReader(f):
+            catalogs.setdefault(row["cluster"], {})[row["song"]] = None
+    return {persona: list(songs) for persona, songs in catalogs.items()}
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Load-test a running RankDist service with simulated sessions.")
+    parser.add_argument("scores", help="the CSV the service was started with")
+    parser.add_argument("--url", default=SERVICE_URL)
+    parser.add_argument("--sessions", type=int, default=32)
+    parser.add_argument("--queries", type=int, default=20, help="queries per session")
+    parser.add_argument("--set-size", type=int, default=5)
+    parser.add_argument("--k", type=int, default=TOP_K)
+    args = parser.parse_args()
+
+    if not service_available(args.url):
+        raise SystemExit(f"No RankDist service at {args.url}.")
+    latencies, wall = simulate_sessions(read_catalog_songs(args.scores), args.sessions, args.queries, args.set_size,
+                                        args.k, args.url)
+    latencies.sort()
+    p50, p99 = latencies[len(latencies) // 2], latencies[int(len(latencies) * 0.99)]
+    print(f"{len(latencies)} queries in {wall:.2f}s ({len(latencies) / wall:.0f}/s), latency "
+          f"p50 {p50 * 1000:.1f}ms, p99 {p99 * 1000:.1f}ms")
+
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,1583 @@
+import hashlib
+import inspect
+import json
+import os
+import threading
+import time
+import numpy as np
+import pandas as pd
+from collections import Counter, OrderedDict
+from concurrent.futures import ProcessPoolExecutor
+from itertools import repeat
+from rankdist_kernels import top_order, rank_counts
+
+TOP_K = 3
+CHUNK_ELEMENTS = 2 ** 21
+QUAD_NODES = 128
+PRUNE_TAIL = 1e-9
+SHARD_SAMPLES = 25000
+RANK_METHODS = ("sample", "exact")
+SAMPLERS = ("mc", "antithetic", "qmc")
+SE_BATCHES = 16
+ANYTIME_BUDGET = 0.05
+ADAPTIVE_DELTA = 0.05
+ADAPTIVE_FIRST_SAMPLES = 1000
+OUT_OF_CORE_BYTES = 256 * 2 ** 20
+OUT_OF_CORE_ROW_BYTES = 32
+MIXTURE_MIN_WEIGHT = 0.01
+BATCH_MAX_SET_SIZE = 32
+ANYTIME_FIRST_ELEMENTS = 2 ** 14
+ANYTIME_FINISH_SECONDS = 1e-6
+QUANTILE_Z = np.linspace(-6.0, 6.0, 513)
+CACHE_MAX_BYTES = 256 * 2 ** 20
+
+SUBTABLE_COLUMNS = ['relevant_set_songs', 'relevant_set_results_alg', 'relevant_set_results_true',
+                    'ordered_list_songs', 'ordered_list_results_alg (by order)', 'ordered_list_results_true (by order)',
+                    'perfect_precision_songs', 'perfect_precision_results_alg', 'perfect_precision_results_true']
+
+
+# Builds a score model with an independent normal score distribution per candidate song
+def normal_scores(songs, means, stds):
+    means = np.asarray(means, dtype=float)
+    stds = np.asarray(stds, dtype=float)
+    if len(songs) != len(means) or len(songs) != len(stds):
+        raise ValueError("songs, means and stds must have the same length.")
+    if np.any(stds < 0):
+        raise ValueError("Score standard deviations must be non-negative.")
+    return {"kind": "normal", "songs": list(songs), "mean": means, "std": stds}
+
+
+# Builds a score model from per-song quantile tables: row j holds song j's score quantile at probability
+# Phi(z) for every z in QUANTILE_Z, so sampling is a table lookup on standard normal noise
+def quantile_scores(songs, table):
+    table = np.asarray(table, dtype=float)
+    if table.shape != (len(songs), len(QUANTILE_Z)):
+        raise ValueError(f"The quantile table must have one row of {len(QUANTILE_Z)} values per song.")
+    if np.any(np.diff(table, axis=1) < 0):
+        raise ValueError("Quantile table rows must be non-decreasing.")
+    return {"kind": "quantile", "songs": list(songs), "table": table}
+
+
+# Builds a score model from observed scores: one array of empirical score samples per song
+def empirical_scores(songs, samples):
+    if len(songs) != len(samples):
+        raise ValueError("songs and samples must have the same length.")
+    if any(len(song_samples) == 0 for song_samples in samples):
+        raise ValueError("Every song needs at least one score sample.")
+    probs = normal_cdf(QUANTILE_Z)
+    return quantile_scores(songs, [np.quantile(np.asarray(song_samples, dtype=float), probs)
+                                   for song_samples in samples])
+
+
+# Builds a score model from score histograms: bin_edges (one shared array or one per song) and per-song counts.
+# Scores are spread uniformly inside each bin.
+def histogram_scores(songs, bin_edges, counts):
+    counts = [np.asarray(song_counts, dtype=float) for song_counts in counts]
+    if len(songs) != len(counts):
+        raise ValueError("songs and counts must have the same length.")
+    shared_edges = np.ndim(bin_edges[0]) == 0
+    probs = normal_cdf(QUANTILE_Z)
+    table = []
+    for j, song_counts in enumerate(counts):
+        edges = np.asarray(bin_edges if shared_edges else bin_edges[j], dtype=float)
+        if len(edges) != len(song_counts) + 1 or song_counts.sum() <= 0 or np.any(song_counts < 0):
+            raise ValueError(f"Histogram of song '{songs[j]}' needs non-negative counts and one more edge than bins.")
+        cdf = np.concatenate([[0.0], np.cumsum(song_counts) / song_counts.sum()])
+        table.append(np.interp(probs, cdf, edges))
+    return quantile_scores(songs, table)
+
+
+# Matrix square root factor L of a covariance (L @ L.T == cov): Cholesky, or a clipped eigendecomposition
+# when the covariance is only positive semi-definite
+def covariance_factor(cov):
+    try:
+        return np.linalg.cholesky(cov)
+    except np.linalg.LinAlgError:
+        values, vectors = np.linalg.eigh(cov)
+        if values.min() < -1e-9 * max(values.max(), 1.0):
+            raise ValueError("The covariance matrix must be positive semi-definite.")
+        return vectors * np.sqrt(np.clip(values, 0.0, None))
+
+
+# Builds a score model with jointly normal, correlated scores: per-song means and a full covariance matrix.
+# The covariance factor is computed once here and reused by every draw.
+def correlated_scores(songs, means, cov):
+    means = np.asarray(means, dtype=float)
+    cov = np.asarray(cov, dtype=float)
+    if len(songs) != len(means) or cov.shape != (len(songs), len(songs)):
+        raise ValueError("means and cov must match the number of songs.")
+    if not np.allclose(cov, cov.T):
+        raise ValueError("The covariance matrix must be symmetric.")
+    return {"kind": "correlated", "songs": list(songs), "mean": means, "cov": cov, "factor": covariance_factor(cov)}
+
+
+# Builds a score model with low-rank-plus-diagonal covariance factors @ factors.T + diag(stds^2): every song loads
+# on a few shared factors (artist, cluster, ...) plus independent noise of its own. Sampling costs O(items * rank).
+def lowrank_scores(songs, means, factors, stds):
+    means = np.asarray(means, dtype=float)
+    factors = np.asarray(factors, dtype=float)
+    stds = np.asarray(stds, dtype=float)
+    if len(songs) != len(means) or len(songs) != len(stds) or factors.ndim != 2 or len(factors) != len(songs):
+        raise ValueError("means, stds and the rows of factors must match the number of songs.")
+    if np.any(stds < 0):
+        raise ValueError("Score standard deviations must be non-negative.")
+    return {"kind": "lowrank", "songs": list(songs), "mean": means, "factors": factors, "std": stds}
+
+
+# Factor loadings with one shared factor per group label (e.g. an artist or an entry of clusters_for_track):
+# songs in the same group get covariance loading^2 on top of their own noise
+def group_factors(groups, loading):
+    labels = sorted({label for song_groups in groups for label in song_groups}, key=str)
+    column = {label: i for i, label in enumerate(labels)}
+    factors = np.zeros((len(groups), len(labels)))
+    for j, song_groups in enumerate(groups):
+        factors[j, [column[label] for label in song_groups]] = loading
+    return factors
+
+
+# Loads per-persona score distributions: one row per (cluster, song) with the song's score mean and std
+def load_persona_scores(file_path):
+    df = pd.read_csv(file_path, encoding='utf-8-sig')
+    missing = {'cluster', 'song', 'mean', 'std'} - set(df.columns)
+    if missing:
+        raise ValueError(f"Score file is missing the columns: {', '.join(sorted(missing))}.")
+    return {int(cluster): normal_scores(group['song'].tolist(), group['mean'], group['std'])
+            for cluster, group in df.groupby('cluster')}
+
+
+# Standard deviation of every song's score on its own
+def marginal_stds(scores):
+    if scores["kind"] == "correlated":
+        return np.sqrt(np.diag(scores["cov"]))
+    if scores["kind"] == "lowrank":
+        return np.sqrt((scores["factors"] ** 2).sum(axis=1) + scores["std"] ** 2)
+    return scores["std"]
+
+
+# Names of the independent noise sources of a score model: one per song, plus one per shared factor
+def noise_names(scores):
+    if scores["kind"] == "lowrank":
+        return scores["songs"] + [f"#factor{i}" for i in range(scores["factors"].shape[1])]
+    return scores["songs"]
+
+
+# Returns a score model restricted to the songs at the given indices
+def select_scores(scores, idx):
+    idx = np.asarray(idx, dtype=np.intp)
+    songs = scores["songs"]
+    if scores["kind"] == "correlated":
+        return correlated_scores([songs[i] for i in idx.tolist()], scores["mean"][idx], scores["cov"][np.ix_(idx, idx)])
+    selected = {"kind": scores["kind"], "songs": [songs[i] for i in idx.tolist()]}
+    for key, value in scores.items():
+        if isinstance(value, np.ndarray):
+            selected[key] = value[idx]
+    return selected
+
+
+# Stable 64-bit number identifying a song, so a song gets the same common random stream in every process
+def song_hash(song):
+    return int.from_bytes(hashlib.sha256(str(song).encode()).digest()[:8], "little")
+
+
+# Per-song random streams shared by every candidate set that contains the song (common random numbers)
+def common_streams(songs, seed, stream_index=0):
+    return [np.random.default_rng([seed, song_hash(song), stream_index]) for song in songs]
+
+
+# Steps of the R_d low-discrepancy sequence in n_dims dimensions (powers of the generalized golden ratio)
+def rd_steps(n_dims):
+    phi = 2.0
+    for _ in range(60):
+        phi = (1.0 + phi) ** (1.0 / (n_dims + 1))
+    return (1.0 / phi) ** np.arange(1, n_dims + 1) % 1.0
+
+
+# Standard normal noise for one chunk of samples, as a (rows x items) matrix.
+# "antithetic" pairs every draw with its negation; "qmc" maps a randomly shifted R_d lattice through the normal
+# inverse CDF, one independent shift per chunk. song_streams (common random numbers) replace rng column by column.
+def standard_normals(rows, n_items, rng, sampler="mc", song_streams=None):
+    if sampler == "qmc":
+        points = (rng.random(n_items) + np.arange(1, rows + 1)[:, None] * rd_steps(n_items)) % 1.0
+        return normal_ppf(np.clip(points, 1e-12, 1.0 - 1e-12))
+    half = (rows + 1) // 2 if sampler == "antithetic" else rows
+    if song_streams is None:
+        z = rng.standard_normal((half, n_items))
+    else:
+        z = np.column_stack([stream.standard_normal(half) for stream in song_streams])
+    if sampler == "antithetic":
+        z = np.vstack([z, -z])[:rows]
+    return z
+
+
+# Looks up per-song quantile tables (items x len(QUANTILE_Z)) at standard normal noise z (rows x items),
+# interpolating linearly between grid points. Gathers from flat value and slope tables to stay close to the
+# cost of the normal transform. items (shaped like z) picks another table row per entry of z.
+def quantile_lookup(table, z, items=None):
+    n_points = len(QUANTILE_Z)
+    position = (np.asarray(z, dtype=float) - QUANTILE_Z[0]) * (1.0 / (QUANTILE_Z[1] - QUANTILE_Z[0]))
+    np.clip(position, 0.0, n_points - 1 - 1e-9, out=position)
+    lower = position.astype(np.intp)
+    position -= lower
+    items = np.arange(table.shape[0]) if items is None else items
+    flat = lower + items * (n_points - 1)
+    return table[:, :-1].ravel()[flat] + position * np.diff(table, axis=1).ravel()[flat]
+
+
+# Turns standard normal noise (rows x noise sources) into scores of the score model. Correlated scores
+# go through one batched matrix multiply with the cached covariance factor.
+def scores_from_normals(scores, z):
+    if scores["kind"] == "quantile":
+        return quantile_lookup(scores["table"], z)
+    if scores["kind"] == "correlated":
+        return scores["mean"] + z @ scores["factor"].T
+    if scores["kind"] == "lowrank":
+        n_items = len(scores["songs"])
+        return scores["mean"] + scores["std"] * z[:, :n_items] + z[:, n_items:] @ scores["factors"].T
+    return scores["mean"] + scores["std"] * z
+
+
+# Draws a (samples x items) matrix of scores from a score model
+def draw_scores(scores, n_samples, rng, sampler="mc", song_streams=None):
+    return scores_from_normals(scores, standard_normals(n_samples, len(noise_names(scores)), rng, sampler,
+                                                        song_streams))
+
+
+# Returns the item indices of every sample sorted from highest to lowest score
+def rank_order(samples):
+    return np.argsort(-samples, axis=1, kind="stable")
+
+
+# Counts the distinct rows of a (samples x k) array of sorted top-k item indices
+def set_counts(top):
+    sets, counts = np.unique(top, axis=0, return_counts=True)
+    return {tuple(int(i) for i in s): int(c) for s, c in zip(sets, counts)}
+
+
+# Counts how often each k-subset of items is exactly the top-k of a sample
+def topk_set_counts(order, k):
+    return set_counts(np.sort(order[:, :k], axis=1))
+
+
+# Counts the top-j sets of the samples for every j in sizes, out of n_items items. With at most 63 items every
+# sample's top-j sets are integer bitmasks from one running sum, so each size needs a one-dimensional unique
+# instead of sorting its rows.
+def prefix_set_counts(order, sizes, n_items):
+    if n_items > 63:
+        counts = {}
+        for size in sizes:
+            counts.update(topk_set_counts(order, size))
+        return counts
+    masks = np.cumsum(np.left_shift(np.int64(1), order[:, :max(sizes)]), axis=1)
+    bits = np.arange(n_items)
+    counts = {}
+    for size in sizes:
+        values, found = np.unique(masks[:, size - 1], return_counts=True)
+        members = np.nonzero((values[:, None] >> bits) & 1)[1].reshape(len(values), size)
+        counts.update(zip(map(tuple, members.tolist()), found.tolist()))
+    return counts
+
+
+# Picks how many samples to draw per chunk so one chunk holds about CHUNK_ELEMENTS scores
+def chunk_rows(n_items, chunk_size=None):
+    if chunk_size is None:
+        chunk_size = CHUNK_ELEMENTS // max(n_items, 1)
+    return max(1, int(chunk_size))
+
+
+# Accumulates rank counts and top-k set counts over bounded-size chunks of samples. The samples are split
+# into at least SE_BATCHES chunks, and each chunk's (rows, top-k counts per item) is kept for standard errors.
+# With all_k=True, the top-j sets of every j from 1 to k are counted in the same pass.
+def sample_rank_counts(scores, k, n_samples, rng, chunk_size=None, n_ranks=None, sampler="mc", song_streams=None,
+                       all_k=False):
+    n_items = len(scores["songs"])
+    counts = np.zeros((n_items, n_items if n_ranks is None else n_ranks), dtype=np.int64)
+    topk_counts = Counter()
+    batches = []
+    rows = min(chunk_rows(n_items, chunk_size), -(-n_samples // SE_BATCHES))
+    if sampler == "antithetic":
+        rows += rows % 2
+    for start in range(0, n_samples, rows):
+        samples = draw_scores(scores, min(rows, n_samples - start), rng, sampler, song_streams)
+        order = rank_order(samples) if n_ranks is None else top_order(samples, n_ranks)
+        add_chunk_counts(counts, topk_counts, batches, order, k, n_ranks, all_k)
+    return counts, topk_counts, batches
+
+
+# Adds one chunk of sampled rank orders to the running rank counts, top-k set counts and per-batch counts.
+# Sets of different sizes (all_k=True) share the set counter, told apart by their length.
+def add_chunk_counts(counts, topk_counts, batches, order, k, n_ranks=None, all_k=False):
+    chunk_counts = rank_counts(order, n_ranks, len(counts))
+    counts += chunk_counts
+    topk_counts.update(prefix_set_counts(order, range(1 if all_k else k, k + 1), len(counts)))
+    add_batch(batches, len(order), chunk_counts[:, :k].sum(axis=1))
+
+
+# Appends one batch's (rows, top-k counts per item) for batch-means standard errors. Adjacent batches are merged
+# in pairs, so a long run keeps at most 2 * SE_BATCHES per-item batch counts.
+def add_batch(batches, rows, topk_counts):
+    batches.append((rows, topk_counts))
+    if len(batches) == 2 * SE_BATCHES:
+        batches[:] = [(rows + more_rows, batch_counts + more_counts)
+                      for (rows, batch_counts), (more_rows, more_counts) in zip(batches[::2], batches[1::2])]
+
+
+# Batch-means standard error of every item's top-k probability, from per-batch (rows, top-k counts)
+def batch_std_error(batches, n_items):
+    if len(batches) < 2:
+        return np.full(n_items, np.nan)
+    sizes = np.array([rows for rows, _ in batches], dtype=float)
+    counts = np.array([batch_counts for _, batch_counts in batches], dtype=float)
+    total = sizes.sum()
+    deviations = counts - sizes[:, None] * (counts.sum(axis=0) / total)
+    return np.sqrt((deviations ** 2).sum(axis=0) * len(batches) / (len(batches) - 1)) / total
+
+
+# Rank counts for one shard of samples, drawn from the shard's own random stream
+def shard_rank_counts(scores, k, n_samples, seed_seq, chunk_size=None, n_ranks=None, sampler="mc", crn_seed=None,
+                      shard_index=0, all_k=False):
+    song_streams = None if crn_seed is None else common_streams(noise_names(scores), crn_seed, shard_index)
+    return sample_rank_counts(scores, k, n_samples, np.random.default_rng(seed_seq), chunk_size, n_ranks, sampler,
+                              song_streams, all_k)
+
+
+# Splits the samples into fixed-size shards with independent seeded streams and counts them on a process pool.
+# The shards and their streams do not depend on n_workers, so the counts are identical for any worker count.
+def parallel_rank_counts(scores, k, n_samples, seed=None, n_workers=None, chunk_size=None, n_ranks=None,
+                         sampler="mc", crn_seed=None, shard_size=SHARD_SAMPLES, all_k=False):
+    n_items = len(scores["songs"])
+    sizes = [min(shard_size, n_samples - start) for start in range(0, n_samples, shard_size)]
+    streams = np.random.SeedSequence(seed).spawn(len(sizes))
+    args = (repeat(scores), repeat(k), sizes, streams, repeat(chunk_size), repeat(n_ranks), repeat(sampler),
+            repeat(crn_seed), range(len(sizes)), repeat(all_k))
+
+    if n_workers == 1 or len(sizes) == 1:
+        results = list(map(shard_rank_counts, *args))
+    else:
+        with ProcessPoolExecutor(max_workers=n_workers) as pool:
+            results = list(pool.map(shard_rank_counts, *args))
+
+    counts = np.zeros((n_items, n_items if n_ranks is None else n_ranks), dtype=np.int64)
+    topk_counts = Counter()
+    batches = []
+    for shard_counts, shard_sets, shard_batches in results:
+        counts += shard_counts
+        topk_counts.update(shard_sets)
+        batches += shard_batches
+    return counts, topk_counts, batches
+
+
+# Rows per out-of-core block, so that drawing or ranking one block stays within max_memory bytes. Each score
+# takes about OUT_OF_CORE_ROW_BYTES while it is drawn (noise, scores, float32 copy) or ranked (sort keys, order).
+def block_rows(n_items, max_memory):
+    return max(1, int(max_memory // (OUT_OF_CORE_ROW_BYTES * n_items)))
+
+
+# Memory-maps rows [start, stop) of a (samples x items) float32 .npy sample file. Mapping one block at a time keeps
+# the file's pages out of the resident memory once the block is released.
+def sample_block(path, start, stop, mode="r"):
+    header = np.load(path, mmap_mode="r")
+    offset, n_items = header.offset, header.shape[1]
+    del header
+    return np.memmap(path, dtype=np.float32, mode=mode, offset=offset + start * n_items * 4,
+                     shape=(stop - start, n_items))
+
+
+# Draws n_samples score samples block by block into a float32 .npy file through numpy.memmap, with shape
+# (samples x items). Only one block of samples is in memory at a time.
+def write_score_samples(scores, n_samples, path, rng, max_memory=OUT_OF_CORE_BYTES, sampler="mc", song_streams=None):
+    n_items = len(scores["songs"])
+    # Writes the .npy header and sizes the file without touching its pages
+    np.lib.format.open_memmap(path, mode="w+", dtype=np.float32, shape=(n_samples, n_items))
+    rows = block_rows(n_items, max_memory)
+    if sampler == "antithetic":
+        rows += rows % 2
+    for start in range(0, n_samples, rows):
+        stop = min(start + rows, n_samples)
+        block = sample_block(path, start, stop, mode="r+")
+        block[:] = draw_scores(scores, stop - start, rng, sampler, song_streams)
+        block.flush()
+        del block
+
+
+# Accumulates rank counts and top-k set counts block by block from a memory-mapped sample file, like
+# sample_rank_counts
+def memmap_rank_counts(path, k, max_memory=OUT_OF_CORE_BYTES, n_ranks=None, all_k=False):
+    n_samples, n_items = np.load(path, mmap_mode="r").shape
+    counts = np.zeros((n_items, n_items if n_ranks is None else n_ranks), dtype=np.int64)
+    topk_counts = Counter()
+    batches = []
+    rows = min(block_rows(n_items, max_memory), -(-n_samples // SE_BATCHES))
+    for start in range(0, n_samples, rows):
+        block = np.array(sample_block(path, start, min(start + rows, n_samples)))
+        order = rank_order(block) if n_ranks is None else top_order(block, n_ranks)
+        add_chunk_counts(counts, topk_counts, batches, order, k, n_ranks, all_k)
+    return counts, topk_counts, batches
+
+
+# Metadata file of a sample bank: its song columns and the fingerprint of the scores and settings it was drawn with
+def bank_meta_path(path):
+    return os.path.splitext(path)[0] + ".json"
+
+
+# Samples a whole catalog's scores once into a persisted bank: a float32 (samples x songs) .npy file in column-major
+# order, so the samples of any candidate subset are contiguous column slices, plus a metadata file. The samples are
+# drawn block by block within max_memory bytes. Returns the bank (see load_sample_bank).
+def build_sample_bank(catalog, path, n_samples=10000, seed=None, sampler="mc", max_memory=OUT_OF_CORE_BYTES):
+    if n_samples <= 0:
+        raise ValueError("n_samples must be positive.")
+    n_items = len(catalog["songs"])
+    rng = np.random.default_rng(seed)
+    tmp_path = path + ".tmp"
+    samples = np.lib.format.open_memmap(tmp_path, mode="w+", dtype=np.float32, shape=(n_samples, n_items),
+                                        fortran_order=True)
+    rows = block_rows(n_items, max_memory)
+    if sampler == "antithetic":
+        rows += rows % 2
+    for start in range(0, n_samples, rows):
+        stop = min(start + rows, n_samples)
+        samples[start:stop] = draw_scores(catalog, stop - start, rng, sampler)
+        samples.flush()
+    del samples
+    os.replace(tmp_path, path)
+    meta = {"songs": list(catalog["songs"]),
+            "key": rank_dist_key(catalog, mode="bank", n_samples=n_samples, seed=seed, sampler=sampler)}
+    with open(bank_meta_path(path), "w", encoding="utf-8") as f:
+        json.dump(meta, f)
+    return load_sample_bank(path)
+
+
+# Opens a persisted sample bank read-only through numpy.memmap
+def load_sample_bank(path):
+    with open(bank_meta_path(path), encoding="utf-8") as f:
+        meta = json.load(f)
+    return {
+        "samples": np.load(path, mmap_mode="r"),
+        "songs": meta["songs"],
+        "column": {song: i for i, song in enumerate(meta["songs"])},
+        "key": meta["key"],
+    }
+
+
+# Opens the sample bank at path when it was drawn from the same catalog and settings, and builds it otherwise
+def open_sample_bank(catalog, path, n_samples=10000, seed=None, sampler="mc", max_memory=OUT_OF_CORE_BYTES):
+    key = rank_dist_key(catalog, mode="bank", n_samples=n_samples, seed=seed, sampler=sampler)
+    if os.path.exists(path) and os.path.exists(bank_meta_path(path)):
+        bank = load_sample_bank(path)
+        if bank["key"] == key:
+            return bank
+    return build_sample_bank(catalog, path, n_samples, seed, sampler, max_memory)
+
+
+# Rank distribution of a candidate subset of a sample bank's songs, in the format of compute_rank_dist. The
+# subset's columns are sliced out of the bank and ranked chunk by chunk (partially, with truncate=True), so sets
+# that share songs share their samples.
+def bank_rank_dist(bank, songs, k=TOP_K, truncate=False, all_k=False, chunk_size=None):
+    missing = [song for song in songs if song not in bank["column"]]
+    if missing:
+        raise ValueError(f"Songs not in the sample bank: {', '.join(map(str, missing))}.")
+    n_items = len(songs)
+    if not 0 < k <= n_items:
+        raise ValueError(f"k must be between 1 and the number of songs ({n_items}).")
+
+    columns = [bank["column"][song] for song in songs]
+    n_samples = len(bank["samples"])
+    n_ranks = k if truncate else None
+    counts = np.zeros((n_items, n_items if n_ranks is None else n_ranks), dtype=np.int64)
+    topk_counts = Counter()
+    batches = []
+    rows = min(chunk_rows(n_items, chunk_size), -(-n_samples // SE_BATCHES))
+    for start in range(0, n_samples, rows):
+        block = np.asarray(bank["samples"][start:start + rows, columns], dtype=float)
+        order = rank_order(block) if n_ranks is None else top_order(block, n_ranks)
+        add_chunk_counts(counts, topk_counts, batches, order, k, n_ranks, all_k)
+
+    rank_probs = counts / n_samples
+    return {
+        "songs": list(songs),
+        "k": k,
+        "rank_probs": truncate_rank_probs(rank_probs, k) if truncate else rank_probs,
+        "truncated": truncate,
+        "topk_sets": {s: c / n_samples for s, c in sorted(topk_counts.items())},
+        "std_error": batch_std_error(batches, n_items),
+        "n_samples": n_samples,
+        "scores": None,
+        "n_candidates": n_items,
+        "n_pruned": 0,
+    }
+
+
+# Two-sided confidence radius of probabilities estimated from n_samples independent draws: the smaller of
+# Hoeffding's radius and Maurer and Pontil's empirical Bernstein radius, each holding with probability 1 - delta / 2
+def bernstein_radius(probs, n_samples, delta):
+    hoeffding = np.sqrt(np.log(4.0 / delta) / (2.0 * n_samples))
+    if n_samples < 2:
+        return np.broadcast_to(hoeffding, np.shape(probs))
+    log_term = np.log(8.0 / delta)
+    variance = probs * (1.0 - probs) * n_samples / (n_samples - 1.0)
+    bernstein = np.sqrt(2.0 * variance * log_term / n_samples) + 7.0 * log_term / (3.0 * (n_samples - 1.0))
+    return np.minimum(hoeffding, bernstein)
+
+
+# Whether the answers of every mode are statistically settled after n_samples draws, each estimated probability
+# within its confidence radius: the top-k songs are separated from the rest, no replacement or swap could improve
+# the ordered list, and the most frequent top-k set beats the runner-up. With exactly k songs the top-k set is
+# certain and only the ordered list's swaps are checked.
+def answers_settled(counts, topk_counts, n_samples, k, delta):
+    n_items = len(counts)
+    probs = counts[:, :k] / n_samples
+    radius = bernstein_radius(probs, n_samples, delta)
+    if n_items > k:
+        marginals = probs.sum(axis=1)
+        marginal_radius = bernstein_radius(marginals, n_samples, delta)
+        order = np.argsort(-marginals, kind="stable")
+        inside, outside = order[:k], order[k:]
+        if (marginals[inside] - marginal_radius[inside]).min() <= \
+                (marginals[outside] + marginal_radius[outside]).max():
+            return False
+
+    discounts = ndcg_discounts(k)
+    chosen = max_weight_assignment(discounts[:, None] * probs.T)
+    others = np.setdiff1d(np.arange(n_items), chosen)
+    margins, uncertainties = ordered_list_margins(discounts * probs, discounts * radius, chosen, others)
+    if (margins <= uncertainties).any():
+        return False
+    if n_items == k:
+        return True
+
+    best, runner_up = (sorted((c for s, c in topk_counts.items() if len(s) == k), reverse=True) + [0])[:2]
+    set_radius = bernstein_radius(np.array([best, runner_up]) / n_samples, n_samples, delta)
+    return (best - runner_up) / n_samples > set_radius.sum()
+
+
+# Samples in doubling rounds, starting at ADAPTIVE_FIRST_SAMPLES, until answers_settled holds or max_samples are
+# drawn.
+# delta is split over the planned rounds and the probabilities estimated in each (rank and top-k probabilities of
+# every song, frequencies of the observed top-k sets), so the stopped answers are settled with probability about
+# 1 - delta. Returns the counts like sample_rank_counts plus the number of samples drawn.
+def adaptive_rank_counts(scores, k, max_samples, rng, chunk_size=None, n_ranks=None, song_streams=None,
+                         delta=ADAPTIVE_DELTA, all_k=False):
+    n_items = len(scores["songs"])
+    targets = [min(ADAPTIVE_FIRST_SAMPLES * 2 ** r, max_samples)
+               for r in range(max(1, int(np.ceil(np.log2(max_samples / ADAPTIVE_FIRST_SAMPLES))) + 1))]
+    counts = np.zeros((n_items, n_items if n_ranks is None else n_ranks), dtype=np.int64)
+    topk_counts = Counter()
+    batches = []
+    drawn = 0
+    for target in targets:
+        round_counts, round_sets, round_batches = sample_rank_counts(scores, k, target - drawn, rng, chunk_size,
+                                                                     n_ranks, "mc", song_streams, all_k)
+        counts += round_counts
+        topk_counts.update(round_sets)
+        batches += round_batches
+        drawn = target
+        if answers_settled(counts, topk_counts, drawn, k,
+                           delta / (len(targets) * (n_items * (k + 1) + len(topk_counts)))):
+            break
+    return counts, topk_counts, batches, drawn
+
+
+# Complementary error function (Numerical Recipes erfcc, relative error below 1.2e-7)
+def erfc(z):
+    z = np.asarray(z, dtype=float)
+    t = 1.0 / (1.0 + 0.5 * np.abs(z))
+    poly = -1.26551223 + t * (1.00002368 + t * (0.37409196 + t * (0.09678418 + t * (-0.18628806 + t * (
+        0.27886807 + t * (-1.13520398 + t * (1.48851587 + t * (-0.82215223 + t * 0.17087277))))))))
+    ans = t * np.exp(-z * z + poly)
+    return np.where(z >= 0, ans, 2.0 - ans)
+
+
+# Standard normal CDF
+def normal_cdf(z):
+    return 0.5 * erfc(-np.asarray(z, dtype=float) / np.sqrt(2.0))
+
+
+# Probability that N(mean, std) is above x, with a step function for zero std
+def normal_sf(x, mean, std):
+    diff = mean - x
+    with np.errstate(divide="ignore", invalid="ignore"):
+        sf = 0.5 * erfc(-diff / (std * np.sqrt(2.0)))
+    step = np.where(diff > 0, 1.0, np.where(diff < 0, 0.0, 0.5))
+    return np.where(std > 0, sf, step)
+
+
+# Inverse of the standard normal CDF (Acklam's rational approximation, relative error below 1.2e-9)
+def normal_ppf(p):
+    p = np.asarray(p, dtype=float)
+    a = [-3.969683028665376e+01, 2.209460984245205e+02, -2.759285104469687e+02,
+         1.383577518672690e+02, -3.066479806614716e+01, 2.506628277459239e+00]
+    b = [-5.447609879822406e+01, 1.615858368580409e+02, -1.556989798598866e+02,
+         6.680131188771972e+01, -1.328068155288572e+01]
+    c = [-7.784894002430293e-03, -3.223964580411365e-01, -2.400758277161838e+00,
+         -2.549732539343734e+00, 4.374664141464968e+00, 2.938163982698783e+00]
+    d = [7.784695709041462e-03, 3.224671290700398e-01, 2.445134137142996e+00, 3.754408661907416e+00]
+
+    with np.errstate(divide="ignore", invalid="ignore"):
+        q = np.sqrt(-2.0 * np.log(np.minimum(p, 1.0 - p)))
+        tail = (((((c[0] * q + c[1]) * q + c[2]) * q + c[3]) * q + c[4]) * q + c[5]) / \
+               ((((d[0] * q + d[1]) * q + d[2]) * q + d[3]) * q + 1.0)
+        r = (p - 0.5) ** 2
+        central = (((((a[0] * r + a[1]) * r + a[2]) * r + a[3]) * r + a[4]) * r + a[5]) * (p - 0.5) / \
+                  (((((b[0] * r + b[1]) * r + b[2]) * r + b[3]) * r + b[4]) * r + 1.0)
+    ppf = np.where(p < 0.02425, tail, np.where(p > 1.0 - 0.02425, -tail, central))
+    return np.where(p <= 0.0, -np.inf, np.where(p >= 1.0, np.inf, ppf))
+
+
+# Gauss-Hermite nodes (items x nodes) and weights for integrating over each item's own score
+def score_quadrature(scores, n_nodes=QUAD_NODES):
+    t, w = np.polynomial.hermite.hermgauss(n_nodes)
+    nodes = scores["mean"][:, None] + np.sqrt(2.0) * scores["std"][:, None] * t[None, :]
+    return nodes, w / np.sqrt(np.pi)
+
+
+# P(item j scores above item i's node q), as an (items x nodes x items) array with j == i excluded
+def beats_probs(scores, nodes):
+    more = normal_sf(nodes[:, :, None], scores["mean"][None, None, :], scores["std"][None, None, :])
+    diagonal = np.arange(len(scores["songs"]))
+    more[diagonal, :, diagonal] = 0.0
+    return more
+
+
+# Adds one more possible beater, with probabilities p (broadcast over the last axis), to a Poisson-binomial
+# distribution of beater counts, in place. The last count must have room for the extra beater, unless
+# absorbing is set and the last count collects every count at or above it.
+def add_beater(dist, p, absorbing=False):
+    if absorbing:
+        top = dist[..., -1:] + dist[..., -2:-1] * p
+    dist[..., 1:] = dist[..., 1:] * (1.0 - p) + dist[..., :-1] * p
+    dist[..., :1] *= 1.0 - p
+    if absorbing:
+        dist[..., -1:] = top
+
+
+# Poisson-binomial DP over the items beating each item's quadrature nodes: (items x nodes x beater counts).
+# With n_counts set, only counts 0..n_counts - 2 are tracked and the last count absorbs the rest.
+def exact_beats_dist(scores, nodes, n_counts=None):
+    n_items = len(scores["songs"])
+    absorbing = n_counts is not None and n_counts < n_items
+    more = beats_probs(scores, nodes)
+    dist = np.zeros(more.shape[:2] + (n_counts if absorbing else n_items,))
+    dist[:, :, 0] = 1.0
+    for j in range(n_items):
+        add_beater(dist, more[:, :, j, None], absorbing)
+    return dist
+
+
+# Exact rank probabilities: integrates the beater-count distribution over each item's own score.
+# With n_ranks set, only the first n_ranks rank columns are computed.
+def exact_rank_probs(scores, n_nodes=QUAD_NODES, n_ranks=None):
+    nodes, weights = score_quadrature(scores, n_nodes)
+    n_counts = None if n_ranks is None else n_ranks + 1
+    return np.einsum("iqr,q->ir", exact_beats_dist(scores, nodes, n_counts), weights)[:, :n_ranks]
+
+
+# Log-probability tables for exact top-k set probabilities: log P(j beats / loses to item i's node q)
+def exact_set_tables(scores, n_nodes=QUAD_NODES):
+    n_items = len(scores["songs"])
+    nodes, weights = score_quadrature(scores, n_nodes)
+    more = np.clip(beats_probs(scores, nodes), 1e-300, 1.0)
+    less = np.clip(1.0 - more, 1e-300, 1.0)
+    diagonal = np.arange(n_items)
+    more[diagonal, :, diagonal] = 1.0
+    less[diagonal, :, diagonal] = 1.0
+    log_less = np.log(less)
+    return {"log_odds": np.log(more) - log_less, "total_less": log_less.sum(axis=2), "weights": weights}
+
+
+# Exact probability of each k-subset (rows of subsets) being exactly the top-k
+def exact_topk_set_probs(tables, subsets):
+    log_odds, total_less, weights = tables["log_odds"], tables["total_less"], tables["weights"]
+    subsets = np.asarray(subsets, dtype=np.intp)
+    node_idx = np.arange(len(weights))[None, :, None]
+
+    # Every member takes a turn as the lowest-scoring song of the subset
+    probs = np.zeros(len(subsets))
+    for member in range(subsets.shape[1]):
+        i = subsets[:, member]
+        inside = log_odds[i[:, None, None], node_idx, subsets[:, None, :]].sum(axis=2)
+        probs += np.exp(inside + total_less[i]) @ weights
+    return probs
+
+
+# Lower and upper score bounds that hold each song's score except with probability tail on either side
+def score_bounds(scores, tail=PRUNE_TAIL):
+    z = normal_ppf(1.0 - tail)
+    if scores["kind"] == "quantile":
+        return quantile_lookup(scores["table"], np.full(len(scores["songs"]), -z)), \
+            quantile_lookup(scores["table"], np.full(len(scores["songs"]), z))
+    stds = marginal_stds(scores)
+    return scores["mean"] - z * stds, scores["mean"] + z * stds
+
+
+# Finds the songs that can still enter the top-k: a song is dropped when k other songs have
+# a lower bound above its upper bound, which leaves it at most (k + 1) * tail chance of making the top-k
+def prune_candidates(scores, k, tail=PRUNE_TAIL):
+    lower, upper = score_bounds(scores, tail)
+    threshold = np.partition(lower, len(lower) - k)[len(lower) - k]
+    return np.flatnonzero(upper >= threshold)
+
+
+# Computes the rank distribution of a score model by sampling or, for independent normal scores, exactly.
+# With prune=True, songs that cannot enter the top-k are dropped first and rank_probs only covers the kept songs.
+# With n_workers set, sampling is sharded over a process pool (n_workers=0 uses every core).
+# With truncate=True, only the first k rank columns are computed (see truncate_rank_probs).
+# sampler picks plain Monte Carlo, antithetic pairs or randomized QMC; common_numbers=True draws every song's noise
+# from a stream keyed by (seed, song), so sets sharing songs share noise. std_error holds the batch-means standard
+# error of each song's top-k probability.
+# With adaptive=True, n_samples is only a cap: sampling stops once the answers of every mode are settled
+# with probability 1 - delta (see adaptive_rank_counts), and the result's n_samples holds the samples drawn.
+# With all_k=True, the same samples also count the top-j sets of every j < k, so the distribution answers every
+# mode for any k from 1 to k (see rankdist_answers_by_k). Exact distributions answer every k already.
+# With sample_file set, sampling runs out of core: the samples are written to that .npy file (kept afterwards)
+# through numpy.memmap and counted block by block, with blocks and rank counts held within max_memory bytes.
+def compute_rank_dist(scores, k=TOP_K, n_samples=10000, seed=None, chunk_size=None, method="sample", prune=False,
+                      n_workers=None, truncate=False, sampler="mc", common_numbers=False, adaptive=False,
+                      delta=ADAPTIVE_DELTA, all_k=False, sample_file=None, max_memory=OUT_OF_CORE_BYTES):
+    n_items = len(scores["songs"])
+    if not 0 < k <= n_items:
+        raise ValueError(f"k must be between 1 and the number of songs ({n_items}).")
+    if method not in RANK_METHODS:
+        raise ValueError(f"method must be one of {RANK_METHODS}.")
+    if method == "exact" and scores["kind"] != "normal":
+        raise ValueError("The exact method needs independent normal scores.")
+    if sampler not in SAMPLERS:
+        raise ValueError(f"sampler must be one of {SAMPLERS}.")
+    if common_numbers and (sampler == "qmc" or not isinstance(seed, (int, np.integer))):
+        raise ValueError("Common random numbers need an integer seed and the mc or antithetic sampler.")
+    if adaptive and (sampler != "mc" or n_workers is not None):
+        raise ValueError("Adaptive sampling needs the mc sampler and no worker pool.")
+    if adaptive and not 0 < delta < 1:
+        raise ValueError("delta must be between 0 and 1.")
+    if sample_file is not None and (adaptive or n_workers is not None):
+        raise ValueError("Out-of-core sampling runs without adaptive stopping or a worker pool.")
+
+    if prune:
+        scores = select_scores(scores, prune_candidates(scores, k))
+
+    # Exact top-k set probabilities are evaluated on demand by the perfect precision search
+    n_ranks = k if truncate else None
+    if method == "exact":
+        rank_probs = exact_rank_probs(scores, n_ranks=n_ranks)
+        topk_sets = None
+        std_error = np.zeros(len(scores["songs"]))
+    else:
+        if n_samples <= 0:
+            raise ValueError("n_samples must be positive.")
+        crn_seed = seed if common_numbers else None
+        if sample_file is not None:
+            # Rank counts and batch counts stay in memory; the sample blocks get the rest of max_memory
+            n_kept = len(scores["songs"])
+            block_memory = max_memory - n_kept * ((n_kept if n_ranks is None else n_ranks) + 2 * SE_BATCHES) * 8
+            if block_memory < max_memory // 2:
+                raise ValueError("The rank counts take over half of max_memory; use truncate=True or prune=True.")
+            song_streams = None if crn_seed is None else common_streams(noise_names(scores), crn_seed)
+            write_score_samples(scores, n_samples, sample_file, np.random.default_rng(seed), block_memory, sampler,
+                                song_streams)
+            counts, topk_counts, batches = memmap_rank_counts(sample_file, k, block_memory, n_ranks, all_k)
+        elif adaptive:
+            song_streams = None if crn_seed is None else common_streams(noise_names(scores), crn_seed)
+            counts, topk_counts, batches, n_samples = adaptive_rank_counts(scores, k, n_samples,
+                                                                           np.random.default_rng(seed), chunk_size,
+                                                                           n_ranks, song_streams, delta, all_k)
+        elif n_workers is None:
+            song_streams = None if crn_seed is None else common_streams(noise_names(scores), crn_seed)
+            counts, topk_counts, batches = sample_rank_counts(scores, k, n_samples, np.random.default_rng(seed),
+                                                              chunk_size, n_ranks, sampler, song_streams, all_k)
+        else:
+            counts, topk_counts, batches = parallel_rank_counts(scores, k, n_samples, seed, n_workers or None,
+                                                                chunk_size, n_ranks, sampler, crn_seed,
+                                                                all_k=all_k)
+        rank_probs = counts / n_samples
+        topk_sets = {s: c / n_samples for s, c in sorted(topk_counts.items())}
+        std_error = batch_std_error(batches, len(scores["songs"]))
+
+    return {
+        "songs": scores["songs"],
+        "k": k,
+        "rank_probs": truncate_rank_probs(rank_probs, k) if truncate else rank_probs,
+        "truncated": truncate,
+        "topk_sets": topk_sets,
+        "std_error": std_error,
+        "n_samples": None if method == "exact" else n_samples,
+        "scores": scores,
+        "n_candidates": n_items,
+        "n_pruned": n_items - len(scores["songs"]),
+    }
+
+
+# Compact rank probabilities: the first k rank columns plus one column with the mass beyond rank k, in float32.
+# Takes O(items * k) memory instead of O(items^2).
+def truncate_rank_probs(rank_probs, k):
+    head = rank_probs[:, :k]
+    beyond = np.clip(1.0 - head.sum(axis=1, keepdims=True), 0.0, 1.0)
+    return np.hstack([head, beyond]).astype(np.float32)
+
+
+# Converts a full rank distribution to the compact top-k representation
+def truncate_rank_dist(rank_dist):
+    if rank_dist.get("truncated"):
+        return rank_dist
+    return dict(rank_dist, rank_probs=truncate_rank_probs(rank_dist["rank_probs"], rank_dist["k"]), truncated=True)
+
+
+# Rank distribution of a user who follows persona c with probability weights[c]: every rank and top-k set
+# probability is the weighted mix of the personas' rank distributions of the same candidate set, so nothing is
+# resampled. Songs pruned from some personas count as ranked beyond k there, which needs the truncated form.
+# Exact components keep their top-k set probabilities lazy, through the mixture's components.
+def mix_rank_dists(rank_dists, weights):
+    weights = np.asarray(weights, dtype=float)
+    if len(rank_dists) == 0 or len(weights) != len(rank_dists) or (weights < 0).any() or weights.sum() <= 0:
+        raise ValueError("Mixture weights must be non-negative, one per rank distribution and not all zero.")
+    if len({rank_dist["k"] for rank_dist in rank_dists}) != 1:
+        raise ValueError("The rank distributions were computed for different k.")
+    weights = weights / weights.sum()
+    songs = list(dict.fromkeys(song for rank_dist in rank_dists for song in rank_dist["songs"]))
+    truncated = any(rank_dist.get("truncated") or rank_dist["songs"] != songs for rank_dist in rank_dists)
+    if truncated:
+        rank_dists = [truncate_rank_dist(rank_dist) for rank_dist in rank_dists]
+
+    position = {song: i for i, song in enumerate(songs)}
+    rank_probs = np.zeros((len(songs), rank_dists[0]["rank_probs"].shape[1]))
+    variance = np.zeros(len(songs))
+    topk_sets = Counter()
+    components = []
+    for weight, rank_dist in zip(weights, rank_dists):
+        idx = np.array([position[song] for song in rank_dist["songs"]], dtype=np.intp)
+        if truncated:
+            rank_probs[:, -1] += weight
+            rank_probs[idx, -1] -= weight
+        rank_probs[idx] += weight * rank_dist["rank_probs"]
+        variance[idx] += (weight * rank_dist["std_error"]) ** 2
+        components.append((weight, rank_dist, idx))
+        if rank_dist["topk_sets"] is not None:
+            for subset, prob in rank_dist["topk_sets"].items():
+                topk_sets[tuple(sorted(int(idx[i]) for i in subset))] += weight * prob
+
+    sampled = all(rank_dist["topk_sets"] is not None for rank_dist in rank_dists)
+    return {
+        "songs": songs,
+        "k": rank_dists[0]["k"],
+        "rank_probs": rank_probs.astype(np.float32) if truncated else rank_probs,
+        "truncated": truncated,
+        "topk_sets": dict(sorted(topk_sets.items())) if sampled else None,
+        "components": None if sampled else components,
+        "std_error": np.sqrt(variance),
+        "n_samples": min(rank_dist["n_samples"] for rank_dist in rank_dists) if sampled else None,
+        "scores": None,
+        "n_candidates": max(rank_dist["n_candidates"] for rank_dist in rank_dists),
+        "n_pruned": max(rank_dist["n_candidates"] for rank_dist in rank_dists) - len(songs),
+    }
+
+
+# The first k rank columns of a rank distribution
+def rank_columns(rank_dist, k):
+    if rank_dist.get("truncated") and k > rank_dist["k"]:
+        raise ValueError(f"Rank probabilities were truncated at k={rank_dist['k']}, cannot answer k={k}.")
+    return rank_dist["rank_probs"][:, :k]
+
+
+# Returns the probability of every item to be in the top-k
+def topk_probs(rank_dist, k=None):
+    k = rank_dist["k"] if k is None else k
+    return rank_columns(rank_dist, k).sum(axis=1, dtype=float)
+
+
+# Relevant set: the k songs most likely to be in the top-k
+def relevant_set_query(rank_dist, k=None):
+    k = rank_dist["k"] if k is None else k
+    probs = topk_probs(rank_dist, k)
+    best = np.argsort(-probs, kind="stable")[:k]
+    return [rank_dist["songs"][i] for i in best]
+
+
+# Solves a rectangular assignment problem (rows <= columns) maximizing the total weight, returning each
+# row's column. Shortest augmenting path Hungarian algorithm, vectorized over columns.
+def max_weight_assignment(weights):
+    cost = -np.asarray(weights, dtype=float)
+    n_rows, n_cols = cost.shape
+    if n_rows > n_cols:
+        raise ValueError("The assignment needs at least as many columns as rows.")
+
+    u = np.zeros(n_rows + 1)
+    v = np.zeros(n_cols + 1)
+    owner = np.zeros(n_cols + 1, dtype=np.intp)
+    way = np.zeros(n_cols + 1, dtype=np.intp)
+    for row in range(1, n_rows + 1):
+        owner[0] = row
+        col = 0
+        min_slack = np.full(n_cols + 1, np.inf)
+        used = np.zeros(n_cols + 1, dtype=bool)
+        while owner[col] != 0:
+            used[col] = True
+            current_row = owner[col]
+            slack = cost[current_row - 1] - u[current_row] - v[1:]
+            improve = ~used[1:] & (slack < min_slack[1:])
+            min_slack[1:][improve] = slack[improve]
+            way[1:][improve] = col
+            free = np.flatnonzero(~used[1:]) + 1
+            next_col = free[np.argmin(min_slack[free])]
+            delta = min_slack[next_col]
+            u[owner[used]] += delta
+            v[used] -= delta
+            min_slack[~used] -= delta
+            col = next_col
+        while col != 0:
+            previous = way[col]
+            owner[col] = owner[previous]
+            col = previous
+
+    assignment = np.empty(n_rows, dtype=np.intp)
+    assigned = np.flatnonzero(owner[1:]) + 1
+    assignment[owner[assigned] - 1] = assigned - 1
+    return assignment
+
+
+# nDCG position discounts 1 / log2(position + 1) for positions 1..k
+def ndcg_discounts(k):
+    return 1.0 / np.log2(np.arange(k) + 2.0)
+
+
+# Ordered list: the ordering maximizing the expected discounted gain, sum over positions of
+# discount(position) * P(song at position), found as a weighted assignment of songs to positions.
+# Some optimal list only uses songs among each position's k best, so large pools are cut to those first.
+def ordered_list_query(rank_dist, k=None):
+    k = rank_dist["k"] if k is None else k
+    weights = ndcg_discounts(k)[:, None] * rank_columns(rank_dist, k).T
+    columns = np.arange(weights.shape[1])
+    if weights.shape[1] > k * k:
+        columns = np.unique(np.argpartition(-weights, k - 1, axis=1)[:, :k])
+    return [rank_dist["songs"][i] for i in columns[max_weight_assignment(weights[:, columns])]]
+
+
+# Margins of an ordered list (chosen songs by position) over its single-step alternatives: replacing a listed song
+# by an unlisted one, or swapping two positions. values holds each (song, position) gain; errors holds an
+# uncertainty per (song, position) that is summed over the terms of each margin. Returns (margins, uncertainties).
+def ordered_list_margins(values, errors, chosen, others):
+    positions = np.arange(len(chosen))
+    held, held_errors = values[chosen, positions], errors[chosen, positions]
+    first, second = np.triu_indices(len(chosen), 1)
+    margins = np.concatenate([
+        (held - values[others]).ravel(),
+        held[first] + held[second] - values[chosen[second], first] - values[chosen[first], second]])
+    uncertainties = np.concatenate([
+        (held_errors + errors[others]).ravel(),
+        held_errors[first] + held_errors[second] + errors[chosen[second], first] + errors[chosen[first], second]])
+    return margins, uncertainties
+
+
+# Probability of each k-subset (rows of song indices) being exactly the top-k
+def topk_set_probs(rank_dist, subsets):
+    if rank_dist.get("components"):
+        subsets = np.asarray(subsets, dtype=np.intp)
+        probs = np.zeros(len(subsets))
+        for weight, component, idx in rank_dist["components"]:
+            local = np.full(len(rank_dist["songs"]), -1, dtype=np.intp)
+            local[idx] = np.arange(len(idx))
+            mapped = local[subsets]
+            present = (mapped >= 0).all(axis=1)
+            if present.any():
+                probs[present] += weight * topk_set_probs(component, mapped[present])
+        return probs
+    if rank_dist["topk_sets"] is not None:
+        return np.array([rank_dist["topk_sets"].get(tuple(sorted(int(i) for i in s)), 0.0) for s in subsets])
+    if "set_tables" not in rank_dist:
+        rank_dist["set_tables"] = exact_set_tables(rank_dist["scores"])
+    return exact_topk_set_probs(rank_dist["set_tables"], subsets)
+
+
+# Branch-and-bound search for the k-subset most likely to be exactly the top-k. Songs are visited by
+# decreasing marginal top-k probability, which bounds the joint probability of any subset containing them.
+def perfect_precision_search(rank_dist, k):
+    marginals = topk_probs(rank_dist, k)
+    order = np.argsort(-marginals, kind="stable")
+    bounds = marginals[order]
+    n_items = len(order)
+    # Sampled sets are all known: the search would return the first most frequent set in its visiting order
+    if rank_dist["topk_sets"] is not None:
+        sets = sampled_topk_sets(rank_dist, k)
+        position = np.empty(n_items, dtype=np.intp)
+        position[order] = np.arange(n_items)
+        top = max(sets.values())
+        winner = min(sorted(position[list(s)]) for s, p in sets.items() if p == top)
+        return [int(order[p]) for p in winner], top, len(sets)
+    best = {"positions": None, "prob": -1.0, "evaluated": 0}
+
+    def extend(prefix, start):
+        need = k - len(prefix)
+        if need == 1:
+            last = np.arange(start, n_items)
+            last = last[bounds[last] > best["prob"]]
+            if len(last) == 0:
+                return
+            subsets = np.column_stack([np.broadcast_to(order[list(prefix)], (len(last), len(prefix))), order[last]])
+            probs = topk_set_probs(rank_dist, subsets)
+            best["evaluated"] += len(last)
+            top = int(np.argmax(probs))
+            if probs[top] > best["prob"]:
+                best["positions"], best["prob"] = prefix + (int(last[top]),), float(probs[top])
+            return
+        for position in range(start, n_items - need + 1):
+            # Every completion holds a song at or after position + need - 1 in marginal order
+            if bounds[position + need - 1] <= best["prob"]:
+                break
+            extend(prefix + (position,), position + 1)
+
+    extend((), 0)
+    return [int(order[p]) for p in best["positions"]], best["prob"], best["evaluated"]
+
+
+# Sampled probabilities of the k-subsets that were exactly the top-k of some sample
+def sampled_topk_sets(rank_dist, k):
+    sets = {s: p for s, p in rank_dist["topk_sets"].items() if len(s) == k}
+    if not sets:
+        raise ValueError(f"Top-k sets were computed for k={rank_dist['k']}, not k={k}; use all_k=True.")
+    return sets
+
+
+# Perfect precision: the k-subset most likely to be exactly the top-k
+def perfect_precision_query(rank_dist, k=None):
+    k = rank_dist["k"] if k is None else k
+    best, _, _ = perfect_precision_search(rank_dist, k)
+    return [rank_dist["songs"][i] for i in best]
+
+
+MODE_QUERIES = {
+    "relevant_set": relevant_set_query,
+    "ordered_list": ordered_list_query,
+    "perfect_precision": perfect_precision_query,
+}
+
+rank_dist_cache = OrderedDict()
+cache_stats = {"hits": 0, "misses": 0, "evictions": 0, "bytes": 0}
+# Guards the cache and its counters across Streamlit session threads. Reentrant, so rankdist_answer can hold it
+# across a membership test and the cache_put that follows.
+cache_lock = threading.RLock()
+
+
+# Answers all three recommendation modes from one rank distribution
+def rankdist_answers(rank_dist, k=None):
+    return {mode: query(rank_dist, k) for mode, query in MODE_QUERIES.items()}
+
+
+# Answers all three modes for every k in k_values (default 1 to the distribution's k) from one rank distribution,
+# computed with all_k=True when it is sampled
+def rankdist_answers_by_k(rank_dist, k_values=None):
+    k_values = range(1, rank_dist["k"] + 1) if k_values is None else k_values
+    return {k: rankdist_answers(rank_dist, k) for k in k_values}
+
+
+# Stable fingerprint of a query: persona, candidate songs, score distribution parameters and settings.
+# The settings are completed with compute_rank_dist's defaults so equivalent calls share a key.
+def rank_dist_key(scores, persona=None, mode=None, **settings):
+    bound = inspect.signature(compute_rank_dist).bind(scores, **settings)
+    bound.apply_defaults()
+    settings = {name: value for name, value in bound.arguments.items() if name != "scores"}
+
+    digest = hashlib.sha256(repr((persona, mode, scores["kind"], scores["songs"], sorted(settings.items()))).encode())
+    for key, value in sorted(scores.items()):
+        if isinstance(value, np.ndarray):
+            digest.update(repr((key, value.dtype.str, value.shape)).encode())
+            digest.update(np.ascontiguousarray(value).tobytes())
+    return digest.hexdigest()
+
+
+# Approximate memory held by a cached value
+def cache_entry_bytes(value):
+    if isinstance(value, np.ndarray):
+        return value.nbytes
+    if isinstance(value, dict):
+        # A snapshot of the items, as a query in another thread may attach a table to a cached rank distribution
+        items = list(value.items())
+        return sum(cache_entry_bytes(k) + cache_entry_bytes(v) for k, v in items) + 64 * len(items)
+    if isinstance(value, (list, tuple)):
+        return sum(cache_entry_bytes(v) for v in value) + 8 * len(value)
+    if isinstance(value, str):
+        return len(value) + 49
+    return 32
+
+
+# Looks a key up in the LRU cache, counting the hit or miss. Returns (found, value).
+def cache_get(key):
+    with cache_lock:
+        if key in rank_dist_cache:
+            rank_dist_cache.move_to_end(key)
+            cache_stats["hits"] += 1
+            return True, rank_dist_cache[key][0]
+        cache_stats["misses"] += 1
+        return False, None
+
+
+# Stores a value in the LRU cache (or refreshes its size), evicting the least recently used entries
+# until the cache fits in max_bytes. The newest entry is always kept.
+def cache_put(key, value, max_bytes=CACHE_MAX_BYTES):
+    size = cache_entry_bytes(value)
+    with cache_lock:
+        if key in rank_dist_cache:
+            cache_stats["bytes"] -= rank_dist_cache.pop(key)[1]
+        rank_dist_cache[key] = (value, size)
+        cache_stats["bytes"] += size
+        while cache_stats["bytes"] > max_bytes and len(rank_dist_cache) > 1:
+            _, (_, evicted_size) = rank_dist_cache.popitem(last=False)
+            cache_stats["bytes"] -= evicted_size
+            cache_stats["evictions"] += 1
+
+
+# Empties the cache and resets its counters
+def clear_cache():
+    with cache_lock:
+        rank_dist_cache.clear()
+        cache_stats.update(hits=0, misses=0, evictions=0, bytes=0)
+
+
+# Cache counters, entry count and hit rate
+def cache_info():
+    with cache_lock:
+        lookups = cache_stats["hits"] + cache_stats["misses"]
+        return dict(cache_stats, entries=len(rank_dist_cache),
+                    hit_rate=cache_stats["hits"] / lookups if lookups else 0.0)
+
+
+# Returns the rank distribution shared by all modes of a candidate set, computing it only on a cache miss
+def cached_rank_dist(scores, persona=None, **settings):
+    key = rank_dist_key(scores, persona, **settings)
+    found, rank_dist = cache_get(key)
+    if not found:
+        rank_dist = compute_rank_dist(scores, **settings)
+        cache_put(key, rank_dist)
+    return rank_dist
+
+
+# Answers one recommendation mode for a candidate set. Answers are cached per mode, and every mode
+# of the same candidate set shares one cached rank distribution. answer_k asks for a shorter answer than the
+# settings' k from the same distribution (compute it with all_k=True for perfect precision).
+def rankdist_answer(scores, mode, persona=None, answer_k=None, **settings):
+    if mode not in MODE_QUERIES:
+        raise ValueError(f"mode must be one of {tuple(MODE_QUERIES)}.")
+    answer_key = rank_dist_key(scores, persona, mode if answer_k is None else (mode, answer_k), **settings)
+    found, answer = cache_get(answer_key)
+    if not found:
+        rank_dist = cached_rank_dist(scores, persona, **settings)
+        dist_key = rank_dist_key(scores, persona, **settings)
+        answer = MODE_QUERIES[mode](rank_dist, settings.get("k", TOP_K) if answer_k is None else answer_k)
+        # Queries may attach lazily built tables to the rank distribution, so its size is refreshed
+        with cache_lock:
+            if dist_key in rank_dist_cache:
+                cache_put(dist_key, rank_dist)
+        cache_put(answer_key, answer)
+    return answer
+
+
+# Computes a rank distribution by sampling until a latency budget (in seconds) runs out or max_samples are drawn.
+# The budget covers pruning, sampling and the work after sampling: building the result and, with answer_modes,
+# answering those modes and their confidence. That finishing work is reserved from the budget by its cost per unit
+# (one unit per item x rank column and per distinct top-k set counted), measured on earlier calls (anytime_cost).
+# The first chunk holds about ANYTIME_FIRST_ELEMENTS scores and is always drawn, so an answer exists even when
+# pruning used the budget up; later chunks grow with the measured sampling speed, and sampling stops when the next
+# chunk and the finishing work it adds would not end before the deadline. A pool too large to prune can still
+# overrun a tight budget by the cost of that first chunk and its finishing work.
+# The result has the format of compute_rank_dist, with n_samples set to the samples actually drawn.
+def anytime_rank_dist(scores, k=TOP_K, budget=ANYTIME_BUDGET, max_samples=10000, seed=None, prune=True,
+                      truncate=True, sampler="mc", answer_modes=()):
+    deadline = time.perf_counter() + budget
+    n_items = len(scores["songs"])
+    if not 0 < k <= n_items:
+        raise ValueError(f"k must be between 1 and the number of songs ({n_items}).")
+    if sampler not in SAMPLERS:
+        raise ValueError(f"sampler must be one of {SAMPLERS}.")
+    if max_samples <= 0:
+        raise ValueError("max_samples must be positive.")
+
+    if prune:
+        scores = select_scores(scores, prune_candidates(scores, k))
+    n_kept = len(scores["songs"])
+    n_ranks = k if truncate else None
+    cells = n_kept * (k if truncate else n_kept)
+    unit_cost = anytime_cost["finish"] + sum(anytime_cost[mode] for mode in answer_modes)
+    rng = np.random.default_rng(seed)
+    counts = np.zeros((n_kept, n_kept if n_ranks is None else n_ranks), dtype=np.int64)
+    topk_counts = Counter()
+    batches = []
+    drawn = 0
+    rows = max(1, ANYTIME_FIRST_ELEMENTS // n_kept)
+    while drawn < max_samples:
+        rows = min(rows, max_samples - drawn)
+        started = time.perf_counter()
+        samples = draw_scores(scores, rows, rng, sampler)
+        order = top_order(samples, k) if truncate else rank_order(samples)
+        add_chunk_counts(counts, topk_counts, batches, order, k, n_ranks)
+        drawn += rows
+        finished = time.perf_counter()
+        # At most double the chunk, and only as many rows as fit before the deadline at the last chunk's speed,
+        # keeping time to finish the units counted so far plus up to one new top-k set per row
+        left = deadline - finished - (cells + len(topk_counts)) * unit_cost
+        fitting = int(left / (max(finished - started, 1e-9) / rows + unit_cost))
+        rows = min(2 * rows, fitting, chunk_rows(n_kept))
+        if sampler == "antithetic" and rows > 1:
+            rows -= rows % 2
+        if rows < 1:
+            break
+
+    sampled = time.perf_counter()
+    rank_probs = counts / drawn
+    rank_dist = {
+        "songs": scores["songs"],
+        "k": k,
+        "rank_probs": truncate_rank_probs(rank_probs, k) if truncate else rank_probs,
+        "truncated": truncate,
+        "topk_sets": {s: c / drawn for s, c in sorted(topk_counts.items())},
+        "std_error": batch_std_error(batches, n_kept),
+        "n_samples": drawn,
+        "complete": drawn == max_samples,
+        "scores": scores,
+        "n_candidates": n_items,
+        "n_pruned": n_items - n_kept,
+    }
+    update_anytime_cost("finish", time.perf_counter() - sampled, cells + len(topk_counts))
+    return rank_dist
+
+
+# Measured cost per unit (item x rank column or distinct top-k set) of the work after anytime sampling: "finish"
+# builds the result and each mode answers it with its confidence. Starts from a conservative guess and follows
+# the measurements, whose decayed total seconds and units per step are kept in anytime_cost_totals.
+anytime_cost = dict.fromkeys(("finish",) + tuple(MODE_QUERIES), ANYTIME_FINISH_SECONDS)
+anytime_cost_totals = dict.fromkeys(anytime_cost, (0.0, 0.0))
+
+
+# Folds one measured duration of a finishing step over its units into anytime_cost. The cost is the step's total
+# time over its total units, so the first measurement replaces the guess and each later one weighs by its size:
+# small steps, dominated by fixed overhead, barely move the cost measured on large ones. Older totals are halved
+# for every ANYTIME_FIRST_ELEMENTS new units.
+def update_anytime_cost(step, seconds, units):
+    total_seconds, total_units = anytime_cost_totals[step]
+    decay = 0.5 ** (units / ANYTIME_FIRST_ELEMENTS)
+    total_seconds, total_units = decay * total_seconds + seconds, decay * total_units + units
+    anytime_cost_totals[step] = (total_seconds, total_units)
+    anytime_cost[step] = total_seconds / total_units
+
+
+# Normal-approximation probability that every margin is really positive, judged by the smallest margin
+# in units of its standard error
+def margin_confidence(margins, variances):
+    margins, variances = np.ravel(margins), np.ravel(variances)
+    if len(margins) == 0:
+        return 1.0
+    with np.errstate(divide="ignore", invalid="ignore"):
+        z = np.nan_to_num(margins / np.sqrt(variances), nan=0.0, posinf=np.inf, neginf=-np.inf)
+    return float(normal_cdf(z.min()))
+
+
+# Agresti-Coull adjusted probabilities estimated from n_samples and their binomial variances. Two counts are added
+# on each side, so estimates of exactly 0 or 1 from a handful of samples are not treated as certain.
+def adjusted_estimates(probs, n_samples):
+    adjusted = (np.asarray(probs, dtype=float) * n_samples + 2.0) / (n_samples + 4.0)
+    return adjusted, adjusted * (1.0 - adjusted) / (n_samples + 4.0)
+
+
+# Confidence that an answer would not change with unlimited samples: the answer has to beat its closest
+# alternatives, whose margins get binomial standard errors from the samples drawn. The alternatives replace one
+# answer song by another song (plus, for the ordered list, swap two positions); for perfect precision it is the
+# runner-up k-subset. Exact rank distributions have confidence 1.
+def answer_confidence(rank_dist, mode, answer):
+    n_samples = rank_dist.get("n_samples")
+    if n_samples is None:
+        return 1.0
+    k = len(answer)
+    chosen = np.array([rank_dist["songs"].index(song) for song in answer])
+    others = np.ones(len(rank_dist["songs"]), dtype=bool)
+    others[chosen] = False
+    others = np.flatnonzero(others)
+
+    if mode == "perfect_precision":
+        probs, spread = adjusted_estimates((sorted(sampled_topk_sets(rank_dist, k).values(), reverse=True)
+                                            + [0.0])[:2], n_samples)
+        return margin_confidence(probs[0] - probs[1], spread.sum())
+    if mode == "relevant_set":
+        probs, spread = adjusted_estimates(topk_probs(rank_dist, k), n_samples)
+        return margin_confidence(probs[chosen][:, None] - probs[others][None, :],
+                                 spread[chosen][:, None] + spread[others][None, :])
+
+    # Ordered list: position j holds chosen[j] with weight discount[j] * P(rank j)
+    probs, spread = adjusted_estimates(rank_columns(rank_dist, k), n_samples)
+    discounts = ndcg_discounts(k)
+    return margin_confidence(*ordered_list_margins(discounts * probs, discounts ** 2 * spread, chosen, others))
+
+
+# Answers one recommendation mode within a latency budget (in seconds), for interactive pages. Returns the best
+# answer found in time with its confidence, the samples drawn, whether sampling finished before the deadline
+# and the elapsed time.
+def anytime_answer(scores, mode, budget=ANYTIME_BUDGET, k=TOP_K, **settings):
+    if mode not in MODE_QUERIES:
+        raise ValueError(f"mode must be one of {tuple(MODE_QUERIES)}.")
+    started = time.perf_counter()
+    rank_dist = anytime_rank_dist(scores, k, budget, answer_modes=(mode,), **settings)
+    answering = time.perf_counter()
+    answer = MODE_QUERIES[mode](rank_dist, k)
+    confidence = answer_confidence(rank_dist, mode, answer)
+    finished = time.perf_counter()
+    n_kept = len(rank_dist["songs"])
+    units = n_kept * (k if rank_dist["truncated"] else n_kept) + len(rank_dist["topk_sets"])
+    update_anytime_cost(mode, finished - answering, units)
+    return {
+        "answer": answer,
+        "confidence": confidence,
+        "n_samples": rank_dist["n_samples"],
+        "complete": rank_dist["complete"],
+        "elapsed": finished - started,
+    }
+
+
+# Answers one recommendation mode for a user blended from several personas. scores_by_persona maps each persona to
+# its score model of the candidate set and memberships[persona] is the user's membership probability (see
+# classification_functions.membership_probabilities). Personas below min_weight are left out; the others' rank
+# distributions come from the cache and are mixed (see mix_rank_dists).
+def mixture_answer(scores_by_persona, memberships, mode, min_weight=MIXTURE_MIN_WEIGHT, **settings):
+    if mode not in MODE_QUERIES:
+        raise ValueError(f"mode must be one of {tuple(MODE_QUERIES)}.")
+    personas = [persona for persona in scores_by_persona if memberships[persona] >= min_weight]
+    if not personas:
+        raise ValueError(f"No persona has a membership probability of at least {min_weight}.")
+    rank_dists = [cached_rank_dist(scores_by_persona[persona], persona, **settings) for persona in personas]
+    mixture = mix_rank_dists(rank_dists, [memberships[persona] for persona in personas])
+    return MODE_QUERIES[mode](mixture, settings.get("k", TOP_K))
+
+
+# Rank distributions of many candidate sets (lists of song names) of one catalog, from shared samples. The sets are
+# padded into a (sets x size) column array and every chunk of samples is ranked for all sets at once: a song's rank
+# in a set is the number of its set-mates ranked above it in the chunk's order of all used songs, a popcount of two
+# bitmasks (up to 63 used songs, else the padded sets are sorted directly). ks[i] is the largest k asked of set i,
+# and its top-j sets are counted for every j up to it as (set, bitmask) integer keys. With crn_seed, every song's
+# noise comes from a stream keyed by (crn_seed, song, stream_index) (see common_streams), so a set's samples do not
+# depend on the other sets in the batch.
+def batch_rank_dists(catalog, sets, ks, n_samples, rng, chunk_size=None, crn_seed=None, stream_index=0):
+    width = max(len(songs) for songs in sets)
+    if width > BATCH_MAX_SET_SIZE:
+        raise ValueError(f"Batched queries take candidate sets of up to {BATCH_MAX_SET_SIZE} songs.")
+    column = {song: i for i, song in enumerate(catalog["songs"])}
+    missing = sorted({str(song) for songs in sets for song in songs if song not in column})
+    if missing:
+        raise ValueError(f"Songs not in the catalog: {', '.join(missing)}.")
+    used = sorted({column[song] for songs in sets for song in songs})
+    scores = select_scores(catalog, used)
+    local = {catalog["songs"][c]: i for i, c in enumerate(used)}
+    song_streams = None if crn_seed is None else common_streams(noise_names(scores), crn_seed, stream_index)
+
+    n_sets = len(sets)
+    sizes = np.array([len(songs) for songs in sets])
+    ks = np.asarray(ks)
+    padded = np.zeros((n_sets, width), dtype=np.intp)
+    for i, songs in enumerate(sets):
+        padded[i, :len(songs)] = [local[song] for song in songs]
+    real = np.arange(width) < sizes[:, None]
+    in_topk = np.arange(width) < ks[:, None]
+    set_idx = np.arange(n_sets)
+    slot_bits = np.left_shift(np.int64(1), np.arange(width))
+    set_masks = np.where(real, np.left_shift(np.int64(1), padded), 0).sum(axis=1, keepdims=True)
+    slot_base = (set_idx[:, None] * width + np.arange(width)) * width
+
+    counts = np.zeros((n_sets, width, width), dtype=np.int64)
+    batches = []
+    set_keys = {j: [] for j in range(1, ks.max() + 1)}
+    rows = min(chunk_rows(len(used) + n_sets * width, chunk_size), -(-n_samples // SE_BATCHES))
+    for start in range(0, n_samples, rows):
+        samples = draw_scores(scores, min(rows, n_samples - start), rng, song_streams=song_streams)
+        if len(used) <= 63:
+            order = rank_order(samples)
+            bits = np.left_shift(np.int64(1), order)
+            above = np.empty_like(bits)
+            np.put_along_axis(above, order, np.cumsum(bits, axis=1) - bits, axis=1)
+            ranks = np.bitwise_count(above[:, padded] & set_masks)
+        else:
+            order = np.argsort(np.where(real, -samples[:, padded], np.inf), axis=2, kind="stable")
+            ranks = np.empty_like(order)
+            np.put_along_axis(ranks, order, np.arange(width), axis=2)
+        flat = slot_base + ranks
+        chunk_counts = np.bincount(flat.ravel(), minlength=n_sets * width * width).reshape(n_sets, width, width)
+        counts += chunk_counts
+        add_batch(batches, len(samples), (chunk_counts * in_topk[:, None, :]).sum(axis=2).ravel())
+        for j, keys in set_keys.items():
+            asked = ks >= j
+            masks = np.einsum("rsw,w->rs", (ranks[:, asked] < j) & real[asked], slot_bits)
+            keys.append(np.unique((set_idx[asked] << width) + masks, return_counts=True))
+
+    topk_sets = [{} for _ in sets]
+    for j, keys in set_keys.items():
+        values, inverse = np.unique(np.concatenate([v for v, _ in keys]), return_inverse=True)
+        totals = np.bincount(inverse, weights=np.concatenate([c for _, c in keys]))
+        members = np.nonzero(((values & ((1 << width) - 1))[:, None] >> np.arange(width)) & 1)[1].reshape(-1, j)
+        for i, subset, total in zip((values >> width).tolist(), map(tuple, members.tolist()), totals.tolist()):
+            topk_sets[i][subset] = total / n_samples
+
+    rank_probs = counts / n_samples
+    std_error = batch_std_error(batches, n_sets * width).reshape(n_sets, width)
+    return [{
+        "songs": list(songs),
+        "k": int(ks[i]),
+        "rank_probs": rank_probs[i, :len(songs), :len(songs)],
+        "truncated": False,
+        "topk_sets": dict(sorted(topk_sets[i].items())),
+        "std_error": std_error[i, :len(songs)],
+        "n_samples": n_samples,
+        "scores": None,
+        "n_candidates": len(songs),
+        "n_pruned": 0,
+    } for i, songs in enumerate(sets)]
+
+
+# Answers a batch of queries in one call. Each request is a dict with "songs" (candidate song names), "mode", an
+# optional "k" (default TOP_K) and either "persona" or "memberships" (persona -> membership probability, mixed like
+# mixture_answer). scores_by_persona maps every persona to its catalog score model. Requests are grouped by
+# persona and each persona's distinct candidate sets of up to BATCH_MAX_SET_SIZE songs are ranked together (see
+# batch_rank_dists), each persona on its own random stream. Larger pools are ranked one by one with pruning and
+# top-k truncation, through the cache (see pool_rank_dist). With common_numbers=True (and an integer seed) the
+# noise is keyed by (seed, song, persona) instead, so a request gets the same answer in whatever batch it arrives.
+# Returns the answers in request order.
+def batch_answers(requests, scores_by_persona, n_samples=10000, seed=None, min_weight=MIXTURE_MIN_WEIGHT,
+                  chunk_size=None, common_numbers=False):
+    if common_numbers and not isinstance(seed, (int, np.integer)):
+        raise ValueError("Common random numbers need an integer seed.")
+    set_ks = {}
+    plans = []
+    for request in requests:
+        songs, mode, k = tuple(request["songs"]), request["mode"], request.get("k", TOP_K)
+        if mode not in MODE_QUERIES:
+            raise ValueError(f"mode must be one of {tuple(MODE_QUERIES)}.")
+        if len(set(songs)) != len(songs) or not 0 < k <= len(songs):
+            raise ValueError("Each request needs distinct songs and k between 1 and the number of songs.")
+        if "memberships" in request:
+            weights = {persona: w for persona, w in request["memberships"].items() if w >= min_weight}
+        else:
+            weights = {request["persona"]: 1.0}
+        if not weights:
+            raise ValueError(f"No persona has a membership probability of at least {min_weight}.")
+        unknown = [persona for persona in weights if persona not in scores_by_persona]
+        if unknown:
+            raise ValueError(f"No scores for personas: {', '.join(map(str, unknown))}.")
+        set_ks.setdefault(songs, set()).add(k)
+        plans.append((songs, mode, k, weights))
+
+    sets_by_persona = {}
+    for songs, _, _, weights in plans:
+        for persona in weights:
+            sets_by_persona.setdefault(persona, {})[songs] = max(set_ks[songs])
+    dists = {}
+    for persona, sets in sets_by_persona.items():
+        small = [songs for songs in sets if len(songs) <= BATCH_MAX_SET_SIZE]
+        dists[persona] = {}
+        if small:
+            rng = np.random.default_rng(None if seed is None else [seed, song_hash(persona)])
+            persona_dists = batch_rank_dists(scores_by_persona[persona], small, [sets[songs] for songs in small],
+                                             n_samples, rng, chunk_size, seed if common_numbers else None,
+                                             song_hash(persona))
+            dists[persona].update(zip(small, persona_dists))
+        for songs in sets:
+            if len(songs) > BATCH_MAX_SET_SIZE:
+                dists[persona][songs] = pool_rank_dist(scores_by_persona[persona], songs, sets[songs], persona,
+                                                       n_samples, seed, common_numbers, len(set_ks[songs]) > 1)
+
+    answers = []
+    for songs, mode, k, weights in plans:
+        if len(weights) == 1:
+            rank_dist = dists[next(iter(weights))][songs]
+        else:
+            rank_dist = mix_rank_dists([dists[persona][songs] for persona in weights], list(weights.values()))
+        answers.append(MODE_QUERIES[mode](rank_dist, k))
+    return answers
+
+
+# Rank distribution of a candidate pool too large for batch_rank_dists, computed with pruning and top-k truncation
+# (all_k=True when smaller k are asked of it too) and kept in the rank distribution cache. Without common numbers
+# the seed is combined with the persona, like batch_answers' streams.
+def pool_rank_dist(catalog, songs, k, persona, n_samples=10000, seed=None, common_numbers=False, all_k=False):
+    column = {song: i for i, song in enumerate(catalog["songs"])}
+    missing = sorted(str(song) for song in songs if song not in column)
+    if missing:
+        raise ValueError(f"Songs not in the catalog: {', '.join(missing)}.")
+    if not common_numbers and seed is not None:
+        seed = [seed, song_hash(persona)]
+    return cached_rank_dist(select_scores(catalog, [column[song] for song in songs]), persona, k=k,
+                            n_samples=n_samples, seed=seed, prune=True, truncate=True, common_numbers=common_numbers,
+                            all_k=all_k)
+
+
+# Draws n_sets random candidate sets of set_size distinct catalog songs, as an (n_sets x set_size) index array.
+# Each row draws a small block of indices with replacement and keeps its first set_size distinct ones, redrawing
+# the rows with too few, so memory stays (sets x block) whatever the catalog size. Catalogs with fewer than twice
+# set_size songs rank random keys over the whole catalog instead, in chunks of rows.
+def sample_candidate_sets(n_catalog, n_sets, set_size, rng):
+    if not 0 < set_size <= n_catalog:
+        raise ValueError(f"set_size must be between 1 and the catalog size ({n_catalog}).")
+    sets = np.empty((n_sets, set_size), dtype=np.intp)
+    if 2 * set_size > n_catalog:
+        rows = chunk_rows(n_catalog)
+        for start in range(0, n_sets, rows):
+            keys = rng.random((min(rows, n_sets - start), n_catalog))
+            sets[start:start + len(keys)] = np.argsort(keys, axis=1)[:, :set_size]
+        return sets
+    width = 2 * set_size + 8
+    pending = np.arange(n_sets)
+    while len(pending):
+        draws = rng.integers(0, n_catalog, (len(pending), width))
+        order = np.argsort(draws, axis=1, kind="stable")
+        sorted_draws = np.take_along_axis(draws, order, axis=1)
+        first = np.ones(draws.shape, dtype=bool)
+        np.put_along_axis(first, order[:, 1:], sorted_draws[:, 1:] != sorted_draws[:, :-1], axis=1)
+        done = first.sum(axis=1) >= set_size
+        keep = first[done] & (np.cumsum(first[done], axis=1) <= set_size)
+        sets[pending[done]] = draws[done][keep].reshape(-1, set_size)
+        pending = pending[~done]
+    return sets
+
+
+# Draws one score sample per candidate set for the set's own songs only, as a (sets x set_size) matrix.
+# Correlated scores mix every song's noise, so they are drawn over the whole catalog and gathered.
+def draw_candidate_scores(catalog, candidates, rng):
+    if catalog["kind"] == "correlated":
+        return np.take_along_axis(draw_scores(catalog, len(candidates), rng), candidates, axis=1)
+    z = rng.standard_normal(candidates.shape)
+    if catalog["kind"] == "quantile":
+        return quantile_lookup(catalog["table"], z, candidates)
+    samples = catalog["mean"][candidates] + catalog["std"][candidates] * z
+    if catalog["kind"] == "lowrank":
+        factor_z = rng.standard_normal((len(candidates), catalog["factors"].shape[1]))
+        samples += np.einsum("rf,rsf->rs", factor_z, catalog["factors"][candidates])
+    return samples
+
+
+# Simulates the persona's true preferences for many candidate sets in one batched pass: every set gets its own
+# draw of the persona's scores, and its candidates come back ordered by true score (n_sets x set_size indices)
+def simulate_true_orders(catalog, candidate_sets, rng, chunk_size=None):
+    width = len(catalog["songs"]) if catalog["kind"] == "correlated" else candidate_sets.shape[1]
+    if catalog["kind"] == "lowrank":
+        width *= 1 + catalog["factors"].shape[1]
+    rows = chunk_rows(width, chunk_size)
+    orders = []
+    for start in range(0, len(candidate_sets), rows):
+        candidates = candidate_sets[start:start + rows]
+        true_scores = draw_candidate_scores(catalog, candidates, rng)
+        orders.append(np.take_along_axis(candidates, rank_order(true_scores), axis=1))
+    return np.concatenate(orders) if orders else np.empty((0, candidate_sets.shape[1]), dtype=np.intp)
+
+
+# Builds a #SET subtable in the format of alg_results/cluster_N.csv from RankDist answers and the true order
+def answers_subtable(songs, answers, true_order=None, k=TOP_K):
+    true_top = list(true_order[:k]) if true_order is not None else []
+
+    def pad_list(lst):
+        return list(lst) + [np.nan] * (len(songs) - len(lst))
+
+    return pd.DataFrame({
+        'relevant_set_songs': songs,
+        'relevant_set_results_alg': pad_list(answers["relevant_set"]),
+        'relevant_set_results_true': pad_list(true_top),
+        'ordered_list_songs': songs,
+        'ordered_list_results_alg (by order)': pad_list(answers["ordered_list"]),
+        'ordered_list_results_true (by order)': pad_list(true_top),
+        'perfect_precision_songs': songs,
+        'perfect_precision_results_alg': pad_list(answers["perfect_precision"]),
+        'perfect_precision_results_true': pad_list(true_top),
+    }, columns=SUBTABLE_COLUMNS)
+
+
+# Builds a #SET subtable in the format of alg_results/cluster_N.csv for a candidate set
+def rankdist_subtable(scores, true_order=None, k=TOP_K, n_samples=10000, seed=None, method="sample"):
+    answers = rankdist_answers(cached_rank_dist(scores, k=k, n_samples=n_samples, seed=seed, method=method), k)
+    return answers_subtable(scores["songs"], answers, true_order, k)
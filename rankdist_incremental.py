@@ -0,0 +1,183 @@
+import numpy as np
+from rankdist_functions import TOP_K, QUAD_NODES, RANK_METHODS
+from rankdist_functions import normal_scores, normal_sf, score_quadrature, add_beater, exact_beats_dist, set_counts
+from rankdist_functions import SE_BATCHES
+from rankdist_functions import rank_order, batch_std_error
+from rankdist_kernels import replace_song
+
+
+# Builds a rank state for a candidate set that can be updated one song at a time.
+# The sample method keeps fixed standard normal draws per song (common random numbers), so an update only
+# rescales one column; the exact method keeps every song's beater-count distribution per quadrature node.
+def init_rank_state(scores, k=TOP_K, method="sample", n_samples=10000, seed=None, n_nodes=QUAD_NODES):
+    if scores["kind"] != "normal":
+        raise ValueError("Incremental updates need independent normal scores.")
+    if method not in RANK_METHODS:
+        raise ValueError(f"method must be one of {RANK_METHODS}.")
+
+    state = {"method": method, "k": k, "scores": scores}
+    if method == "exact":
+        nodes, weights = score_quadrature(scores, n_nodes)
+        state.update(nodes=nodes, weights=weights, dist=exact_beats_dist(scores, nodes))
+    else:
+        rng = np.random.default_rng(seed)
+        z = rng.standard_normal((n_samples, len(scores["songs"])))
+        samples = scores["mean"] + scores["std"] * z
+        ranks = np.empty(z.shape, dtype=np.int32)
+        np.put_along_axis(ranks, rank_order(samples), np.arange(z.shape[1], dtype=np.int32)[None, :], axis=1)
+        state.update(rng=rng, z=z, ranks=ranks)
+    return state
+
+
+# Whether song m (scores x_m) beats each song in each sample, ties going to the lower index like a stable sort
+def song_beats(x_m, m, samples):
+    x_m = x_m[:, None]
+    return ((x_m > samples) | ((x_m == samples) & (m < np.arange(samples.shape[1])))).astype(np.int32)
+
+
+# Number of songs beating song m (scores x_m) in each sample
+def song_rank(x_m, m, samples):
+    x_m = x_m[:, None]
+    beaten_by = (samples > x_m) | ((samples == x_m) & (np.arange(samples.shape[1]) < m))
+    beaten_by[:, m] = False
+    return beaten_by.sum(axis=1)
+
+
+# Removes a possible beater with probabilities p from a beater-count distribution (inverse of add_beater).
+# Deconvolution runs forward where p < 0.5 and backward elsewhere, the numerically stable direction for each.
+def remove_beater(dist, p):
+    p = np.broadcast_to(p, dist.shape[:-1] + (1,))[..., 0]
+    forward = p < 0.5
+    result = np.zeros_like(dist)
+    n_counts = dist.shape[-1]
+
+    q = np.where(forward, 1.0 - p, 1.0)
+    carry = np.zeros(dist.shape[:-1])
+    for r in range(n_counts - 1):
+        carry = np.where(forward, (dist[..., r] - p * carry) / q, 0.0)
+        result[..., r] = carry
+
+    p_safe = np.where(forward, 1.0, p)
+    carry = np.zeros(dist.shape[:-1])
+    for r in range(n_counts - 1, 0, -1):
+        carry = np.where(forward, 0.0, (dist[..., r] - (1.0 - p) * carry) / p_safe)
+        result[..., r - 1] = np.where(forward, result[..., r - 1], carry)
+    return np.clip(result, 0.0, 1.0)
+
+
+# Beater-count distribution of song m's own quadrature nodes against every other song
+def song_beats_dist(scores, m, nodes_m):
+    n_items = len(scores["songs"])
+    dist = np.zeros((len(nodes_m), n_items))
+    dist[:, 0] = 1.0
+    for j in range(n_items):
+        if j != m:
+            add_beater(dist, normal_sf(nodes_m, scores["mean"][j], scores["std"][j])[:, None])
+    return dist
+
+
+# Finds a song's index in the rank state
+def song_index(state, song):
+    if song not in state["scores"]["songs"]:
+        raise ValueError(f"Song '{song}' is not in the candidate set.")
+    return state["scores"]["songs"].index(song)
+
+
+# Replaces one song's score distribution and updates the rank state in O(items) work per sample or node
+def update_song(state, song, mean, std):
+    m = song_index(state, song)
+    old = state["scores"]
+    new_mean, new_std = old["mean"].copy(), old["std"].copy()
+    new_mean[m], new_std[m] = mean, std
+    scores = normal_scores(old["songs"], new_mean, new_std)
+
+    if state["method"] == "exact":
+        others = np.arange(len(scores["songs"])) != m
+        dist, nodes = state["dist"], state["nodes"]
+        updated = remove_beater(dist[others], normal_sf(nodes[others], old["mean"][m], old["std"][m])[..., None])
+        add_beater(updated, normal_sf(nodes[others], mean, std)[..., None])
+        dist[others] = updated
+        nodes[m] = score_quadrature(scores, nodes.shape[1])[0][m]
+        dist[m] = song_beats_dist(scores, m, nodes[m])
+    else:
+        samples = old["mean"] + old["std"] * state["z"]
+        replace_song(state["ranks"], samples, m, mean + std * state["z"][:, m])
+    state["scores"] = scores
+    return state
+
+
+# Adds a song to the candidate set and updates the rank state
+def add_song(state, song, mean, std):
+    old = state["scores"]
+    if song in old["songs"]:
+        raise ValueError(f"Song '{song}' is already in the candidate set.")
+    scores = normal_scores(old["songs"] + [song], np.append(old["mean"], mean), np.append(old["std"], std))
+    m = len(old["songs"])
+
+    if state["method"] == "exact":
+        nodes = np.vstack([state["nodes"], score_quadrature(scores, state["nodes"].shape[1])[0][m]])
+        dist = np.concatenate([state["dist"], np.zeros(state["dist"].shape[:2] + (1,))], axis=2)
+        add_beater(dist, normal_sf(nodes[:m], mean, std)[..., None])
+        dist = np.concatenate([dist, song_beats_dist(scores, m, nodes[m])[None]], axis=0)
+        state.update(nodes=nodes, dist=dist)
+    else:
+        z = np.column_stack([state["z"], state["rng"].standard_normal(len(state["z"]))])
+        samples = scores["mean"] + scores["std"] * z
+        ranks = state["ranks"] + song_beats(samples[:, m], m, samples[:, :m])
+        state.update(z=z, ranks=np.column_stack([ranks, song_rank(samples[:, m], m, samples)]).astype(np.int32))
+    state["scores"] = scores
+    return state
+
+
+# Removes a song from the candidate set and updates the rank state
+def remove_song(state, song):
+    m = song_index(state, song)
+    old = state["scores"]
+    if len(old["songs"]) <= state["k"]:
+        raise ValueError(f"The candidate set needs more than k={state['k']} songs to remove one.")
+    keep = np.arange(len(old["songs"])) != m
+    scores = normal_scores([s for i, s in enumerate(old["songs"]) if i != m], old["mean"][keep], old["std"][keep])
+
+    if state["method"] == "exact":
+        nodes = state["nodes"][keep]
+        dist = remove_beater(state["dist"][keep], normal_sf(nodes, old["mean"][m], old["std"][m])[..., None])
+        state.update(nodes=nodes, dist=dist[:, :, :-1])
+    else:
+        samples = old["mean"] + old["std"] * state["z"]
+        ranks = state["ranks"] - song_beats(samples[:, m], m, samples)
+        state.update(z=state["z"][:, keep], ranks=ranks[:, keep])
+    state["scores"] = scores
+    return state
+
+
+# Current rank distribution of the state, in the same format as compute_rank_dist. Sampled states get batch-means
+# standard errors over SE_BATCHES row blocks of the rank matrix.
+def state_rank_dist(state):
+    scores, k = state["scores"], state["k"]
+    n_items = len(scores["songs"])
+    if state["method"] == "exact":
+        rank_probs = np.einsum("iqr,q->ir", state["dist"], state["weights"])
+        topk_sets = None
+        std_error = np.zeros(n_items)
+        n_samples = None
+    else:
+        ranks = state["ranks"]
+        n_samples = len(ranks)
+        flat = np.arange(n_items) * n_items + ranks
+        rank_probs = np.bincount(flat.ravel(), minlength=n_items * n_items).reshape(n_items, n_items) / n_samples
+        top = np.nonzero(ranks < k)[1].reshape(n_samples, k)
+        topk_sets = {s: c / n_samples for s, c in set_counts(top).items()}
+        blocks = np.array_split(ranks < k, min(SE_BATCHES, n_samples))
+        std_error = batch_std_error([(len(block), block.sum(axis=0)) for block in blocks], n_items)
+    return {
+        "songs": scores["songs"],
+        "k": k,
+        "rank_probs": rank_probs,
+        "truncated": False,
+        "topk_sets": topk_sets,
+        "std_error": std_error,
+        "n_samples": n_samples,
+        "scores": scores,
+        "n_candidates": n_items,
+        "n_pruned": 0,
+    }
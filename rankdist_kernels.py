@@ -0,0 +1,156 @@
+import numpy as np
+
+try:
+    import numba
+except ImportError:
+    numba = None
+
+KERNEL_BACKENDS = ("numpy", "numba")
+
+kernel_backend = {"name": "numba" if numba is not None else "numpy"}
+
+
+# Item indices of every sample's k highest scores, from highest to lowest, exactly like the first k columns of a
+# stable argsort of -samples. Songs strictly above the k-th score are kept, and ties at the k-th score go to the
+# lowest indices, so only a partial sort of each row is needed; short rows are cheaper to sort fully.
+def numpy_top_order(samples, k):
+    if 16 * k >= samples.shape[1]:
+        return np.argsort(-samples, axis=1, kind="stable")[:, :k]
+    neg = -samples
+    kth = np.partition(neg, k - 1, axis=1)[:, k - 1:k]
+    better = neg < kth
+    ties = neg == kth
+    keep = better | (ties & (np.cumsum(ties, axis=1) <= k - better.sum(axis=1, keepdims=True)))
+    top = np.nonzero(keep)[1].reshape(len(samples), k)
+    return np.take_along_axis(top, np.argsort(np.take_along_axis(neg, top, axis=1), axis=1, kind="stable"), axis=1)
+
+
+# Counts how often each item lands at each of the first n_ranks ranks, as an (items x n_ranks) matrix
+def numpy_rank_counts(order, n_ranks, n_items):
+    flat = order[:, :n_ranks] * n_ranks + np.arange(n_ranks)
+    return np.bincount(flat.ravel(), minlength=n_items * n_ranks).reshape(n_items, n_ranks)
+
+
+# Replaces song m's scores (column m of samples) by new_column and updates every sample's ranks in place.
+# A song beats another when its score is higher, ties going to the lower index like a stable sort.
+def numpy_replace_song(ranks, samples, m, new_column):
+    later = m < np.arange(samples.shape[1])
+    old, new = samples[:, m:m + 1], new_column[:, None]
+    old_beats = (old > samples) | ((old == samples) & later)
+    new_beats = (new > samples) | ((new == samples) & later)
+    ranks += new_beats.astype(np.int32) - old_beats.astype(np.int32)
+    samples[:, m] = new_column
+    beaten_by = (samples > new) | ((samples == new) & ~later)
+    beaten_by[:, m] = False
+    ranks[:, m] = beaten_by.sum(axis=1)
+
+
+KERNELS = {
+    "numpy": {
+        "top_order": numpy_top_order,
+        "rank_counts": numpy_rank_counts,
+        "replace_song": numpy_replace_song,
+    },
+}
+
+if numba is not None:
+    # Top-k selection by insertion into a sorted buffer: a score only moves ahead of strictly lower scores,
+    # so ties keep index order
+    @numba.njit(cache=True)
+    def numba_top_order(samples, k):
+        rows, n_items = samples.shape
+        k = min(k, n_items)
+        order = np.empty((rows, k), dtype=np.intp)
+        best = np.empty(k)
+        for s in range(rows):
+            filled = 0
+            for j in range(n_items):
+                x = samples[s, j]
+                if filled == k and not x > best[k - 1]:
+                    continue
+                position = filled if filled < k else k - 1
+                while position > 0 and x > best[position - 1]:
+                    best[position] = best[position - 1]
+                    order[s, position] = order[s, position - 1]
+                    position -= 1
+                best[position] = x
+                order[s, position] = j
+                if filled < k:
+                    filled += 1
+        return order
+
+    @numba.njit(cache=True)
+    def numba_rank_counts(order, n_ranks, n_items):
+        counts = np.zeros((n_items, n_ranks), dtype=np.int64)
+        for s in range(order.shape[0]):
+            for r in range(n_ranks):
+                counts[order[s, r], r] += 1
+        return counts
+
+    @numba.njit(cache=True)
+    def numba_replace_song(ranks, samples, m, new_column):
+        rows, n_items = samples.shape
+        for s in range(rows):
+            old = samples[s, m]
+            new = new_column[s]
+            rank = 0
+            for j in range(n_items):
+                if j == m:
+                    continue
+                x = samples[s, j]
+                old_beats = old > x or (old == x and m < j)
+                new_beats = new > x or (new == x and m < j)
+                ranks[s, j] += np.int32(new_beats) - np.int32(old_beats)
+                if x > new or (x == new and j < m):
+                    rank += 1
+            ranks[s, m] = rank
+            samples[s, m] = new
+
+    KERNELS["numba"] = {
+        "top_order": numba_top_order,
+        "rank_counts": numba_rank_counts,
+        "replace_song": numba_replace_song,
+    }
+
+
+# Picks the kernel backend by name, or the fastest installed one with None. Both backends give identical results.
+def set_kernel_backend(name=None):
+    name = ("numba" if numba is not None else "numpy") if name is None else name
+    if name not in KERNEL_BACKENDS:
+        raise ValueError(f"backend must be one of {KERNEL_BACKENDS}.")
+    if name not in KERNELS:
+        raise ValueError(f"The {name} backend needs the {name} package.")
+    kernel_backend["name"] = name
+
+
+# Item indices of every sample's k highest scores, from highest to lowest (the first k columns of rank_order)
+def top_order(samples, k):
+    return KERNELS[kernel_backend["name"]]["top_order"](np.ascontiguousarray(samples, dtype=float), k)
+
+
+# Counts how often each item lands at each of the first n_ranks ranks (all ranks by default),
+# as an (items x n_ranks) matrix. n_items is needed when order only holds the first ranks of each sample.
+def rank_counts(order, n_ranks=None, n_items=None):
+    n_items = order.shape[1] if n_items is None else n_items
+    n_ranks = n_items if n_ranks is None else n_ranks
+    return KERNELS[kernel_backend["name"]]["rank_counts"](np.ascontiguousarray(order, dtype=np.intp), n_ranks,
+                                                          n_items)
+
+
+# Replaces song m's scores in a (samples x items) score matrix and updates the int32 rank matrix in place
+def replace_song(ranks, samples, m, new_column):
+    KERNELS[kernel_backend["name"]]["replace_song"](ranks, samples, m, np.ascontiguousarray(new_column, dtype=float))
+
+
+# Runs the current backend's kernels once on tiny inputs, so Numba loads (or compiles) them now rather than inside
+# the first timed query. Numba's first call takes about 0.15 s even from its on-disk cache.
+def warm_up_kernels():
+    samples = np.arange(6.0).reshape(2, 3)
+    order = top_order(samples, 2)
+    rank_counts(order, 2, 3)
+    replace_song(np.zeros((2, 3), dtype=np.int32), samples.copy(), 0, samples[:, 1])
+
+
+# Anytime queries time every chunk against their budget, so the compiled kernels are ready before the first one
+if numba is not None:
+    warm_up_kernels()
@@ -0,0 +1,248 @@
+import argparse
+import asyncio
+import json
+from concurrent.futures import ProcessPoolExecutor
+from rankdist_functions import batch_answers, load_persona_scores
+
+SERVICE_HOST = "127.0.0.1"
+SERVICE_PORT = 8765
+BATCH_WINDOW = 0.005
+BATCH_MAX_REQUESTS = 4096
+MAX_BODY_BYTES = 16 * 2 ** 20
+HTTP_REASONS = {200: "OK", 400: "Bad Request", 404: "Not Found", 405: "Method Not Allowed",
+                413: "Payload Too Large", 500: "Internal Server Error"}
+
+engine = {"scores": None, "settings": {}}
+
+
+# Loads the personas' score models into an engine worker process, keyed by the persona as a string
+# (JSON object keys are strings, so memberships always name personas that way)
+def init_engine(scores_path, settings):
+    engine["scores"] = {str(persona): scores for persona, scores in load_persona_scores(scores_path).items()}
+    engine["settings"] = settings
+
+
+# Answers one coalesced batch in an engine worker, as {"answer": ...} or {"error": ...} per request.
+# The batch is answered in one batch_answers call; if a request in it is invalid, every request is retried alone
+# so only the invalid ones fail.
+def answer_batch(requests):
+    try:
+        return [{"answer": answer} for answer in batch_answers(requests, engine["scores"], **engine["settings"])]
+    except (ValueError, KeyError, TypeError):
+        results = []
+        for request in requests:
+            try:
+                results.append({"answer": batch_answers([request], engine["scores"], **engine["settings"])[0]})
+            except (ValueError, KeyError, TypeError) as error:
+                results.append({"error": str(error) if isinstance(error, ValueError) else f"Invalid request: {error}"})
+        return results
+
+
+# Coalesces the requests submitted within window seconds of the first pending one (or max_requests of them) into
+# one answer_batch call on the engine pool. Batches are dispatched without waiting for earlier ones, so under load
+# every pool process works on its own batch. Returns the async submit(requests) -> results function.
+def micro_batcher(pool, window=BATCH_WINDOW, max_requests=BATCH_MAX_REQUESTS):
+    state = {"pending": [], "timer": None}
+
+    def settle(batch, done):
+        if done.exception() is not None:
+            for _, future in batch:
+                if not future.done():
+                    future.set_exception(done.exception())
+            return
+        for (_, future), result in zip(batch, done.result()):
+            if not future.done():
+                future.set_result(result)
+
+    def dispatch():
+        if state["timer"] is not None:
+            state["timer"].cancel()
+        batch, state["pending"], state["timer"] = state["pending"], [], None
+        if batch:
+            done = asyncio.get_running_loop().run_in_executor(pool, answer_batch, [request for request, _ in batch])
+            done.add_done_callback(lambda done: settle(batch, done))
+
+    async def submit(requests):
+        loop = asyncio.get_running_loop()
+        futures = [loop.create_future() for _ in requests]
+        if not state["pending"]:
+            state["timer"] = loop.call_later(window, dispatch)
+        state["pending"] += zip(requests, futures)
+        if len(state["pending"]) >= max_requests:
+            dispatch()
+        return await asyncio.gather(*futures)
+
+    return submit
+
+
+# Checks the shape of a POST /answers body and returns its requests with personas as strings
+def parse_requests(body):
+    payload = json.loads(body)
+    if not isinstance(payload, dict) or not isinstance(payload.get("requests"), list):
+        raise ValueError('The body must be a JSON object with a "requests" list.')
+    requests = []
+    for request in payload["requests"]:
+        if not isinstance(request, dict) or not isinstance(request.get("songs"), list):
+            raise ValueError('Each request must be an object with a "songs" list.')
+        if "memberships" in request:
+            if not isinstance(request["memberships"], dict):
+                raise ValueError('"memberships" must map personas to membership probabilities.')
+        elif "persona" in request:
+            request = dict(request, persona=str(request["persona"]))
+        else:
+            raise ValueError('Each request needs a "persona" or "memberships".')
+        requests.append(request)
+    return requests
+
+
+# Sends one JSON response through an ASGI send callable
+async def send_json(send, status, payload):
+    body = json.dumps(payload).encode()
+    await send({"type": "http.response.start", "status": status,
+                "headers": [(b"content-type", b"application/json"), (b"content-length", str(len(body)).encode())]})
+    await send({"type": "http.response.body", "body": body})
+
+
+# ASGI app of the query service, runnable by any ASGI server or by serve_http.
+# POST /answers takes {"requests": [...]} (requests as in batch_answers) and returns {"results": [...]} in request
+# order, each {"answer": [...]} or {"error": "..."}; GET /health returns {"status": "ok"}. The engine pool is shut
+# down on the ASGI lifespan shutdown event.
+def make_app(pool, window=BATCH_WINDOW, max_requests=BATCH_MAX_REQUESTS):
+    submit = micro_batcher(pool, window, max_requests)
+
+    async def app(scope, receive, send):
+        if scope["type"] == "lifespan":
+            while True:
+                message = await receive()
+                if message["type"] == "lifespan.startup":
+                    await send({"type": "lifespan.startup.complete"})
+                elif message["type"] == "lifespan.shutdown":
+                    pool.shutdown(cancel_futures=True)
+                    await send({"type": "lifespan.shutdown.complete"})
+                    return
+        if scope["type"] != "http":
+            return
+
+        if scope["path"] == "/health":
+            await send_json(send, 200, {"status": "ok"})
+            return
+        if scope["path"] != "/answers":
+            await send_json(send, 404, {"error": f"No endpoint at {scope['path']}."})
+            return
+        if scope["method"] != "POST":
+            await send_json(send, 405, {"error": "Use POST for /answers."})
+            return
+        body = b""
+        while True:
+            message = await receive()
+            body += message.get("body", b"")
+            if len(body) > MAX_BODY_BYTES:
+                await send_json(send, 413, {"error": f"Request bodies are limited to {MAX_BODY_BYTES} bytes."})
+                return
+            if not message.get("more_body", False):
+                break
+        try:
+            requests = parse_requests(body)
+        except ValueError as error:
+            await send_json(send, 400, {"error": str(error)})
+            return
+        try:
+            results = await submit(requests)
+        except Exception as error:
+            await send_json(send, 500, {"error": f"The engine failed: {error}"})
+            return
+        await send_json(send, 200, {"results": results})
+
+    return app
+
+
+# Serves one keep-alive HTTP/1.1 connection by passing each request to the ASGI app
+async def serve_connection(app, reader, writer):
+    try:
+        while True:
+            head = await reader.readuntil(b"\r\n\r\n")
+            request_line, *header_lines = head.decode("latin-1").split("\r\n")[:-2]
+            method, target, version = request_line.split(" ")
+            headers = [tuple(line.split(":", 1)) for line in header_lines]
+            headers = [(name.strip().lower().encode("latin-1"), value.strip().encode("latin-1"))
+                       for name, value in headers]
+            lookup = dict(headers)
+            length = int(lookup.get(b"content-length", b"0"))
+            if length > MAX_BODY_BYTES:
+                writer.write(b"HTTP/1.1 413 Payload Too Large\r\ncontent-length: 0\r\nconnection: close\r\n\r\n")
+                break
+            body = await reader.readexactly(length)
+            path, _, query = target.partition("?")
+            scope = {"type": "http", "asgi": {"version": "3.0"}, "http_version": version.split("/")[1],
+                     "method": method, "scheme": "http", "path": path, "raw_path": path.encode(),
+                     "query_string": query.encode(), "root_path": "", "headers": headers,
+                     "client": writer.get_extra_info("peername"), "server": writer.get_extra_info("sockname")}
+            received = {"done": False}
+
+            async def receive():
+                if received["done"]:
+                    return {"type": "http.disconnect"}
+                received["done"] = True
+                return {"type": "http.request", "body": body, "more_body": False}
+
+            async def send(message):
+                if message["type"] == "http.response.start":
+                    lines = [f"HTTP/1.1 {message['status']} {HTTP_REASONS.get(message['status'], '')}".encode()]
+                    lines += [name + b": " + value for name, value in message.get("headers", [])]
+                    writer.write(b"\r\n".join(lines) + b"\r\n\r\n")
+                elif message["type"] == "http.response.body":
+                    writer.write(message.get("body", b""))
+
+            await app(scope, receive, send)
+            await writer.drain()
+            if lookup.get(b"connection", b"").lower() == b"close" or version == "HTTP/1.0":
+                break
+    except (asyncio.IncompleteReadError, ConnectionError, ValueError):
+        pass
+    finally:
+        writer.close()
+
+
+# Minimal local HTTP/1.1 server for an ASGI app, so the service runs with the standard library alone
+async def serve_http(app, host=SERVICE_HOST, port=SERVICE_PORT):
+    startup = asyncio.Queue()
+    await startup.put({"type": "lifespan.startup"})
+    lifespan = asyncio.create_task(app({"type": "lifespan"}, startup.get, lambda message: asyncio.sleep(0)))
+    server = await asyncio.start_server(lambda reader, writer: serve_connection(app, reader, writer), host, port)
+    print(f"RankDist service listening on http://{host}:{port}")
+    try:
+        async with server:
+            await server.serve_forever()
+    finally:
+        await startup.put({"type": "lifespan.shutdown"})
+        await lifespan
+
+
+def main():
+    parser = argparse.ArgumentParser(description="Serve RankDist answers over local HTTP, batching close requests.")
+    parser.add_argument("scores", help="CSV with columns cluster, song, mean, std")
+    parser.add_argument("--host", default=SERVICE_HOST)
+    parser.add_argument("--port", type=int, default=SERVICE_PORT)
+    parser.add_argument("--samples", type=int, default=10000)
+    parser.add_argument("--window", type=float, default=BATCH_WINDOW * 1000,
+                        help="milliseconds to wait for more requests before answering a batch")
+    parser.add_argument("--max-batch", type=int, default=BATCH_MAX_REQUESTS, help="requests per batch at most")
+    parser.add_argument("--workers", type=int, default=None, help="engine processes (default: every core)")
+    parser.add_argument("--seed", type=int, default=0,
+                        help="seed of every song's noise stream, so a repeated query gets the same answer")
+    args = parser.parse_args()
+
+    load_persona_scores(args.scores)
+    # Common random numbers keep a set's samples independent of the batch and worker it lands in, so Streamlit
+    # reruns of the same query cannot flip close-call answers
+    settings = {"n_samples": args.samples, "seed": args.seed, "common_numbers": True}
+    pool = ProcessPoolExecutor(max_workers=args.workers, initializer=init_engine, initargs=(args.scores, settings))
+    app = make_app(pool, window=args.window / 1000, max_requests=args.max_batch)
+    try:
+        asyncio.run(serve_http(app, args.host, args.port))
+    except KeyboardInterrupt:
+        pass
+
+
+if __name__ == "__main__":
+    main()